@@ -6,20 +6,23 @@ import queue
 import sys
 import time
 # Third Party Code
-import pandas
 import serial.tools.list_ports as list_ports
 # Custom Code
+from . import capture
 from . import daq
+from . import export
 from . import grapher
+from . import maintenance
 from . import model
 from . import serializer
-from . import serial_settings
+from . import simulator
 from . import utils
 
 log = logging.getLogger(__name__)
 
 RANDOM = 'random'
 SAWTOOTH = 'sawtooth'
+MT_NEWBALANCE = 'mt-newbalance'
 
 
 def main(options):
@@ -33,38 +36,59 @@ def main(options):
                           notes=options.notes,
                           user=options.user)
 
-    if options.test == RANDOM:
-        daqt = daq.MockDAQ(serial_port_settings={},
-                           output_queue=daq_queue,
-                           die_event=die_event)
-    elif options.test == SAWTOOTH:
-        daqt = daq.MockSawtoothDAQ(serial_port_settings={},
-                                   output_queue=daq_queue,
-                                   die_event=die_event)
-    else:
+    driver_name = options.test or options.driver
+    try:
+        driver = daq.get_driver(driver_name)
+    except daq.DAQError as e:
+        log.error('{}'.format(e))
+        sys.exit(1)
+    ps = {}
+    if driver.default_serial_settings is not None:
         # Now we use a real DAQ!
         port = options.port
         if not port:
             log.error('Must specify a port.')
             sys.exit(1)
-        ps = serial_settings.MT_NCLASSIC_DEFAULT.copy()
+        ps = driver.default_serial_settings.copy()
         ps['port'] = options.port
-        daqt = daq.MettlerNBDAQ(serial_port_settings=ps,
-                                output_queue=daq_queue,
-                                die_event=die_event,
-                                stable_only=options.stable_only)
+        if options.baudrate:
+            ps['baudrate'] = options.baudrate
+    capture_fp = None
+    if options.capture_dir:
+        if not os.path.isdir(options.capture_dir):
+            os.makedirs(options.capture_dir)
+        capture_fp = os.path.join(options.capture_dir,
+                                  '{}_{:%Y%m%d_%H%M%S}.dgcap.gz'.format(ls.name, ls.start))
+    log.info('Using DAQ driver [{}]'.format(driver_name))
+    daqt = driver(serial_port_settings=ps,
+                  output_queue=daq_queue,
+                  die_event=die_event,
+                  stable_only=options.stable_only,
+                  capture_fp=capture_fp,
+                  sics_mode=options.sics_mode,
+                  sics_window=options.sics_window)
     daqt.name = 'DAQ-Thread'
     sert = serializer.DBSerializer(output_queue=serial_queue,
                                    die_event=die_event,
                                    serial_lock=serial_lock,
                                    db_fp=options.db,
                                    logsession=ls,
-                                   print_diff=options.print_diff)
+                                   print_diff=options.print_diff,
+                                   stats_window=options.stats_window,
+                                   ewma_alpha=options.ewma_alpha,
+                                   persist_stats=options.persist_stats,
+                                   detect_events=options.detect_events,
+                                   event_window=options.event_window,
+                                   event_tolerance=options.event_tolerance,
+                                   min_step=options.min_step)
     sert.name = 'SERT-Thread'
     # noinspection PyUnusedLocal
     c = grapher.Canvas(output_queue=vis_queue,
                        n=100,
-                       close_event=close_event)
+                       close_event=close_event,
+                       show_stats=options.show_stats,
+                       stats_window=options.stats_window,
+                       ewma_alpha=options.ewma_alpha)
     threads = [daqt, sert]
     for thread in threads:
         thread.start()
@@ -107,50 +131,100 @@ def main(options):
     sys.exit(0)
 
 
+def open_db(fp):
+    """
+    Check that a database exists, and bring its schema up to date.
+
+    :param fp: Path to the database.
+    :return:
+    """
+    if not os.path.isfile(fp):
+        log.error('DB is not a file. [{}]'.format(fp))
+        sys.exit(1)
+    model.upgrade_db(fp)
+
+
 def dump_sessions(options):
-    if not os.path.isfile(options.db):
-        log.error('DB is not a file. [{}]'.format(options.db))
+    open_db(options.db)
+    if options.events is not None:
+        dump_session_events(options)
+    rows = model.iter_sessions(options.db,
+                               user=options.user,
+                               since=options.since,
+                               name=options.name,
+                               limit=options.limit,
+                               offset=options.offset)
+    columns = sorted(c.name for c in model.LogSession.__table__.columns)
+    table = utils.StreamingTable(columns, max_width=37)
+    if not table.print_rows(rows):
+        log.error('No LogSession rows found.')
         sys.exit(1)
+    sys.exit(0)
+
+
+def dump_session_events(options):
     with model.session_scope(options.db) as s:
-        r = s.query(model.LogSession).all()
+        r = s.query(model.LogEvent).filter_by(session_id=options.events).order_by(model.LogEvent.id).all()
         r = [model.row2dict(row) for row in r]
     if not r:
-        log.error('No LogSession rows found.')
+        log.error('No LogEvent rows found for id: {}'.format(options.events))
         sys.exit(1)
     ba = utils.BetterAsciiTable('')
-    ba.add_rows(r, wrap_keys={'notes': {'width': 37}})
+    ba.add_rows(r)
     print(ba.table)
     sys.exit(0)
 
 
 def dump_session_data(options):
-    if not os.path.isfile(options.db):
-        log.error('DB is not a file. [{}]'.format(options.db))
+    open_db(options.db)
+    if not options.id and options.since is None:
+        log.error('Either session ids or --since must be given.')
         sys.exit(1)
-    with model.session_scope(options.db) as s:
-        r = s.query(model.LogData).filter_by(session_id=options.id).all()
-        r = [model.row2dict(row) for row in r]
-    if not r:
-        log.error('No rows found for id: {}'.format(options.id))
+    fmt = options.format
+    if fmt is None:
+        ext = os.path.splitext(options.output or '')[1].lstrip('.').lower()
+        fmt = ext if ext in export.FORMATS else export.XLSX
+    try:
+        id_ranges = export.parse_ids(options.id or [])
+        sessions = export.select_sessions(options.db, id_ranges=id_ranges, since=options.since)
+        found = {row[0] for row in sessions}
+        # Gaps in a range of ids are expected, so only report ids which were asked for on their own.
+        for lo, hi in id_ranges:
+            if lo == hi and lo not in found:
+                log.error('No LogSession found for id: {}'.format(lo))
+        if not sessions:
+            log.error('No sessions found to dump.')
+            sys.exit(1)
+        results, rows, elapsed = export.export_sessions(options.db,
+                                                        sessions,
+                                                        output_dir=options.output_dir,
+                                                        fmt=fmt,
+                                                        events=options.events,
+                                                        jobs=options.jobs,
+                                                        batch_size=options.batch_size,
+                                                        output=options.output)
+    except export.ExportError as e:
+        log.error(str(e))
+        sys.exit(1)
+    if not rows:
+        log.error('No rows found to dump.')
         sys.exit(1)
-    fp = options.output
-    if not options.output:
-        with model.session_scope(options.db) as s:
-            ls = s.query(model.LogSession).filter_by(id=options.id).one()
-            fp = '{}_{}_{}.xlsx'.format(ls.name, ls.start, ls.stop)
-    log.info('Writing data to [{}]'.format(fp))
-    df = pandas.DataFrame(r)
-    df.to_excel(fp, index=False)
     sys.exit(0)
 
 
 def replay_session(options):
-    if not os.path.isfile(options.db):
-        log.error('DB is not a file. [{}]'.format(options.db))
-        sys.exit(1)
-    with model.session_scope(options.db) as s:
-        r = s.query(model.LogData).filter_by(session_id=options.id).all()
-        r = [row.data for row in r]
+    open_db(options.db)
+    signals = []
+    for session_id in options.id:
+        times, values = maintenance.load_session_arrays(options.db, session_id)
+        if not len(values):
+            log.error('No rows found for id: {}'.format(session_id))
+            sys.exit(1)
+        log.info('Loaded {} rows for id: {}'.format(len(values), session_id))
+        signals.append((times, values))
+    if len(signals) > 1:
+        compare_sessions(signals, n=options.points)
+    r = signals[0][1].tolist()
 
     die_event = multiprocessing.Event()
     close_event = multiprocessing.Event()
@@ -164,7 +238,10 @@ def replay_session(options):
     # noinspection PyUnusedLocal
     c = grapher.Canvas(output_queue=vis_queue,
                        n=100,
-                       close_event=close_event)
+                       close_event=close_event,
+                       show_stats=options.show_stats,
+                       stats_window=options.stats_window,
+                       ewma_alpha=options.ewma_alpha)
     daqt.start()
 
     # noinspection PyBroadException
@@ -197,6 +274,131 @@ def replay_session(options):
     sys.exit(0)
 
 
+def compare_sessions(signals, n=1000):
+    """
+    Show several sessions side by side until the window is closed.
+
+    :param signals: List of (relative time, value) numpy array pairs.
+    :param n: Number of points to plot for each session.
+    :return:
+    """
+    close_event = multiprocessing.Event()
+    # noinspection PyUnusedLocal
+    c = grapher.SessionCanvas(signals=signals,
+                              n=n,
+                              close_event=close_event)
+    try:
+        grapher.app.create()
+        while not close_event.is_set():
+            grapher.app.process_events()
+            time.sleep(0.01)
+    except KeyboardInterrupt:
+        log.info('Caught KeyboardInterrupt')
+    finally:
+        grapher.app.quit()
+    sys.exit(0)
+
+
+def maintain_db(options):
+    try:
+        session_ids, reclaimed = maintenance.maintain(options.db,
+                                                      older_than=options.older_than,
+                                                      archive_dir=options.archive_dir,
+                                                      batch_size=options.batch_size,
+                                                      full_vacuum=options.full_vacuum,
+                                                      dry_run=options.dry_run)
+    except maintenance.MaintenanceError as e:
+        log.error('{}'.format(e))
+        sys.exit(1)
+    if options.dry_run:
+        log.info('Would archive sessions: {}'.format(session_ids))
+    else:
+        log.info('Archived {} sessions, reclaimed {} bytes'.format(len(session_ids), reclaimed))
+    sys.exit(0)
+
+
+def reprocess_capture(options):
+    if not os.path.isfile(options.capture):
+        log.error('Capture is not a file. [{}]'.format(options.capture))
+        sys.exit(1)
+    notes = options.notes
+    if notes is None:
+        notes = 'Reprocessed from {}'.format(options.capture)
+    ls = model.LogSession(name=options.name,
+                          notes=notes,
+                          user=options.user)
+    sert = serializer.DBSerializer(output_queue=None,
+                                   die_event=None,
+                                   serial_lock=None,
+                                   db_fp=options.db,
+                                   logsession=ls,
+                                   print_diff=False,
+                                   persist_stats=options.persist_stats)
+    start = time.monotonic()
+    try:
+        count = sert.write_samples(daq.reprocess_capture(options.capture, stable_only=options.stable_only))
+    except capture.CaptureError as e:
+        log.error('{}'.format(e))
+        sys.exit(1)
+    elapsed = time.monotonic() - start
+    log.info('Reprocessed {} samples into session {} in {:.3f}s'.format(count, sert.session_id, elapsed))
+    sys.exit(0)
+
+
+def simulate_balance(options):
+    die_event = multiprocessing.Event()
+    sims = []
+    for i in range(options.ports):
+        if options.sics:
+            try:
+                sim = simulator.SICSBalanceSimulator(die_event=die_event,
+                                                     baudrate=options.baudrate,
+                                                     line_rate=options.line_rate,
+                                                     latency=options.latency,
+                                                     unit=options.unit,
+                                                     noise=options.noise,
+                                                     seed=i)
+            except simulator.SimulatorError as e:
+                log.error('{}'.format(e))
+                sys.exit(1)
+            sim.name = 'SICS-Simulator-{}'.format(i)
+            sims.append(sim)
+            continue
+        if options.capture:
+            lines = simulator.capture_lines(options.capture, loop=options.loop)
+        else:
+            lines = simulator.generate_lines(mode=options.mode,
+                                             unit=options.unit,
+                                             noise=options.noise,
+                                             seed=i)
+        try:
+            sim = simulator.BalanceSimulator(lines=lines,
+                                             die_event=die_event,
+                                             baudrate=options.baudrate,
+                                             line_rate=options.line_rate)
+        except simulator.SimulatorError as e:
+            log.error('{}'.format(e))
+            sys.exit(1)
+        sim.name = 'Simulator-{}'.format(i)
+        sims.append(sim)
+    for sim in sims:
+        print(sim.port)
+    for sim in sims:
+        sim.start()
+    try:
+        while any(sim.is_alive() for sim in sims):
+            time.sleep(0.1)
+    except KeyboardInterrupt:
+        log.info('Caught KeyboardInterrupt')
+    finally:
+        die_event.set()
+        for sim in sims:
+            sim.join()
+    log.info('Sent {} lines at {:.1f} lines/s'.format(sum(sim.count for sim in sims),
+                                                      sum(sim.rate for sim in sims)))
+    sys.exit(0)
+
+
 # noinspection PyUnusedLocal,PyShadowingNames
 def call_list_ports(opts):
     """
@@ -210,6 +412,21 @@ def call_list_ports(opts):
     sys.exit(0)
 
 
+def add_stats_arguments(p):
+    """
+    Add the streaming statistics options to a subparser.
+
+    :param p: argparse parser.
+    :return:
+    """
+    p.add_argument('--no-stats', dest='show_stats', default=True, action='store_false',
+                   help='Do not plot the smoothed weight, rolling stddev and drift rate.')
+    p.add_argument('--stats-window', dest='stats_window', default=30, type=int,
+                   help='Number of samples used for the rolling statistics.')
+    p.add_argument('--ewma-alpha', dest='ewma_alpha', default=0.1, type=float,
+                   help='Smoothing factor for the exponentially weighted moving average.')
+
+
 def get_parser():
     p = argparse.ArgumentParser(description='Runs the datagrapher application.')
     subps = p.add_subparsers(help='sub-command help')
@@ -220,7 +437,19 @@ def get_parser():
     collect = subps.add_parser('collect', help='Collect, graph and store data.')
     collect.set_defaults(func=main)
     collect.add_argument('-t', '--test', dest='test', choices=[None, RANDOM, SAWTOOTH], default=None, type=str.lower,
-                         help='Perform a data capture and serialization test.')
+                         help='Perform a data capture and serialization test.  This is a shortcut for the random '
+                              'and sawtooth drivers.')
+    collect.add_argument('--driver', dest='driver', default=MT_NEWBALANCE, type=str,
+                         help='DAQ driver to collect data with.  This may be a registered driver name ({}), the name '
+                              'of a {} entry point, or a package.module:ClassName path.'
+                              .format(', '.join(sorted(daq.DRIVERS)), daq.ENTRY_POINT_GROUP))
+    collect.add_argument('-b', '--baudrate', dest='baudrate', default=None, type=int,
+                         help='Override the default baud rate of the DAQ driver.')
+    collect.add_argument('--sics-mode', dest='sics_mode', default=daq.MettlerSICSDAQ.SIR,
+                         choices=daq.MettlerSICSDAQ.MODES, type=str.upper,
+                         help='For the mt-sics driver, poll with continuous SIR output or with pipelined SI requests.')
+    collect.add_argument('--sics-window', dest='sics_window', default=4, type=int,
+                         help='For the mt-sics driver in SI mode, the number of requests kept in flight.')
     collect.add_argument('-c', '--collection-name', dest='name', default='Collection', action='store', type=str,
                          help='Name of the data collection')
     collect.add_argument('-n', '--notes', dest='notes', default=None, action='store', type=str,
@@ -233,22 +462,116 @@ def get_parser():
                          help='Do not print the difference value written to the database.')
     collect.add_argument('-s', '--stable-only', dest='stable_only', default=False, action='store_true',
                          help='Only record stable values')
+    collect.add_argument('--capture-dir', dest='capture_dir', default=None, type=str,
+                         help='Record the raw serial data for the session to a compressed capture file in this '
+                              'directory.')
+    collect.add_argument('--persist-stats', dest='persist_stats', default=False, action='store_true',
+                         help='Store the streaming statistics in the database.')
+    add_stats_arguments(collect)
+    collect.add_argument('--no-events', dest='detect_events', default=True, action='store_false',
+                         help='Do not detect plateau and step events.')
+    collect.add_argument('--event-window', dest='event_window', default=10, type=int,
+                         help='Number of samples which must be stable to start a plateau.')
+    collect.add_argument('--event-tolerance', dest='event_tolerance', default=0.01, type=float,
+                         help='Maximum deviation from the plateau mean before a plateau ends.')
+    collect.add_argument('--min-step', dest='min_step', default=0.05, type=float,
+                         help='Minimum change between plateaus which is recorded as a step event.')
     listd = subps.add_parser('list', help='List session collection data')
     listd.set_defaults(func=dump_sessions)
+    listd.add_argument('-e', '--events', dest='events', default=None, type=int,
+                       help='List the plateau and step events for a session instead of the sessions.')
+    listd.add_argument('-u', '--user', dest='user', default=None, type=str,
+                       help='Only list sessions collected by this user.')
+    listd.add_argument('--since', default=None, type=utils.parse_date,
+                       help='Only list sessions started on or after this date (YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS).')
+    listd.add_argument('-n', '--name', dest='name', default=None, type=str,
+                       help='Only list sessions whose name starts with this.')
+    listd.add_argument('-l', '--limit', dest='limit', default=None, type=int,
+                       help='Maximum number of sessions to list.')
+    listd.add_argument('--offset', dest='offset', default=0, type=int,
+                       help='Number of matching sessions to skip, for paging through them with --limit.')
     listp = subps.add_parser('ports', help='List serial ports available for use')
     listp.set_defaults(func=call_list_ports)
     dumpd = subps.add_parser('dump', help='Dump session collection data')
     dumpd.set_defaults(func=dump_session_data)
-    dumpd.add_argument('-i', '--id', required=True, type=int,
-                       help='Dump the data from a particular data collection to a xlsx file.')
+    dumpd.add_argument('-i', '--id', default=None, type=str, nargs='+',
+                       help='Sessions to dump.  Each may be an id, an inclusive range of ids such as 5-9, or a comma '
+                            'separated list of either.')
+    dumpd.add_argument('--since', default=None, type=utils.parse_date,
+                       help='Dump sessions started on or after this date (YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS).  '
+                            'Combined with --id, only the given sessions started since this date are dumped.')
     dumpd.add_argument('-o', '--output', default=None, type=str,
-                       help='File to dump the data out too')
+                       help='File to dump the data out too, when dumping a single session')
+    dumpd.add_argument('-O', '--output-dir', dest='output_dir', default='.', type=str,
+                       help='Directory to write the files into.  Each session is written to its own file.')
+    dumpd.add_argument('-f', '--format', dest='format', default=None, choices=export.FORMATS,
+                       help='Output format.  Defaults to the extension of --output, or xlsx.  csv is streamed to the '
+                            'file and is much faster for large sessions.')
+    dumpd.add_argument('-j', '--jobs', dest='jobs', default=None, type=int,
+                       help='Number of sessions to dump in parallel.  Defaults to the number of CPUs.')
+    dumpd.add_argument('--batch-size', dest='batch_size', default=10000, type=int,
+                       help='Number of rows to read from the database at a time.')
+    dumpd.add_argument('-e', '--events', dest='events', default=False, action='store_true',
+                       help='Dump the plateau and step events instead of the raw data.')
     replay = subps.add_parser('replay', help='Replay the visualization for a given session')
-    replay.add_argument('-i', '--id', required=True, type=int,
-                        help='Session ID to replay the data from.')
+    replay.add_argument('-i', '--id', required=True, type=int, nargs='+',
+                        help='Session ID to replay the data from.  If multiple IDs are given, the sessions are '
+                             'shown side by side, aligned on the time since each session started.')
     replay.add_argument('-r', '--replay-rate', default=0.3, type=float, dest='replay_rate',
                         help='Rate in which to replay events from the database.')
+    replay.add_argument('--points', default=1000, type=int, dest='points',
+                        help='Number of points to plot for each session when comparing sessions.')
+    add_stats_arguments(replay)
     replay.set_defaults(func=replay_session)
+    reprocess = subps.add_parser('reprocess', help='Parse a raw serial capture into a new session')
+    reprocess.set_defaults(func=reprocess_capture)
+    reprocess.add_argument('-f', '--capture', dest='capture', required=True, type=str,
+                           help='Capture file to reprocess.')
+    reprocess.add_argument('-c', '--collection-name', dest='name', default='Reprocessed', action='store', type=str,
+                           help='Name of the new data collection')
+    reprocess.add_argument('-n', '--notes', dest='notes', default=None, action='store', type=str,
+                           help='Notes related to the data collection')
+    reprocess.add_argument('-u', '--username', dest='user', default=utils.current_user(), action='store', type=str,
+                           help='User performing the reprocessing')
+    reprocess.add_argument('-s', '--stable-only', dest='stable_only', default=False, action='store_true',
+                           help='Only record stable values')
+    reprocess.add_argument('--persist-stats', dest='persist_stats', default=False, action='store_true',
+                           help='Store the streaming statistics in the database.')
+    simulate = subps.add_parser('simulate', help='Simulate balances on pseudo-terminals for load testing')
+    simulate.set_defaults(func=simulate_balance)
+    simulate.add_argument('-n', '--ports', dest='ports', default=1, type=int,
+                          help='Number of simulated balances (serial ports) to create.')
+    simulate.add_argument('-f', '--capture', dest='capture', default=None, type=str,
+                          help='Replay a raw serial capture, or a capture file made with --capture-dir, '
+                               'instead of generating lines.')
+    simulate.add_argument('--loop', dest='loop', default=False, action='store_true',
+                          help='Replay the capture file continuously.')
+    simulate.add_argument('-m', '--mode', dest='mode', default=simulator.HOST, choices=simulator.MODES,
+                          type=str.lower, help='Balance output format to generate.')
+    simulate.add_argument('-b', '--baudrate', dest='baudrate', default=9600, type=int,
+                          help='Simulated baud rate.')
+    simulate.add_argument('-r', '--line-rate', dest='line_rate', default=None, type=float,
+                          help='Maximum lines per second for each port.  By default only the baud rate limits it.')
+    simulate.add_argument('--sics', dest='sics', default=False, action='store_true',
+                          help='Answer MT-SICS commands (SI, S, SIR and @) instead of sending lines unprompted.')
+    simulate.add_argument('--latency', dest='latency', default=0.0, type=float,
+                          help='Time the simulated balance takes to process each MT-SICS command, in seconds.')
+    simulate.add_argument('--unit', dest='unit', default='g', type=str,
+                          help='Unit of the generated weights.')
+    simulate.add_argument('--noise', dest='noise', default=0.0005, type=float,
+                          help='Standard deviation of the noise added to the generated weights.')
+    maintain = subps.add_parser('maintain', help='Archive old sessions and compact the database')
+    maintain.set_defaults(func=maintain_db)
+    maintain.add_argument('--older-than', dest='older_than', default=30.0, type=float,
+                          help='Archive sessions which stopped more than this many days ago.')
+    maintain.add_argument('-a', '--archive-dir', dest='archive_dir', default='archive', type=str,
+                          help='Directory to write the session archives into.')
+    maintain.add_argument('--batch-size', dest='batch_size', default=10000, type=int,
+                          help='Number of rows to delete per transaction.')
+    maintain.add_argument('--full-vacuum', dest='full_vacuum', default=False, action='store_true',
+                          help='Allow a full VACUUM to enable incremental vacuuming on older databases.')
+    maintain.add_argument('--dry-run', dest='dry_run', default=False, action='store_true',
+                          help='Only report the sessions which would be archived.')
 
     return p
 
@@ -0,0 +1,96 @@
+"""
+Raw serial capture files.
+
+A capture file is a gzip compressed stream of records, one per read from
+the serial port.  Each record is the receive timestamp (int64 nanoseconds
+since the unix epoch) and the length of the data, followed by the raw
+bytes exactly as they were read.  Captures can be re-parsed later with
+different parsing rules.
+"""
+import gzip
+import logging
+import struct
+
+log = logging.getLogger(__name__)
+
+MAGIC = b'DGCAP1\n'
+RECORD = struct.Struct('<qI')
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+class CaptureError(Exception):
+    pass
+
+
+class CaptureWriter(object):
+    """
+    Writes records to a capture file.
+    """
+    def __init__(self, fp: str, compresslevel: int =6):
+        self.fp = fp
+        self.f = gzip.open(fp, 'wb', compresslevel=compresslevel)
+        self.f.write(MAGIC)
+        self.count = 0
+
+    def write(self, ts: int, data: bytes):
+        """
+        Add a record to the capture.
+
+        :param ts: Receive time, in nanoseconds since the unix epoch.
+        :param data: Raw bytes read from the serial port.
+        :return:
+        """
+        self.f.write(RECORD.pack(ts, len(data)))
+        self.f.write(data)
+        self.count += 1
+
+    def close(self):
+        log.info('Wrote {} records to capture [{}]'.format(self.count, self.fp))
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def is_capture(fp: str) -> bool:
+    """
+    Check if a file is a capture file.
+
+    :param fp: Path to the file.
+    :return:
+    """
+    with open(fp, 'rb') as f:
+        if f.read(len(GZIP_MAGIC)) != GZIP_MAGIC:
+            return False
+    with gzip.open(fp, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def iter_capture(fp: str):
+    """
+    Stream the records from a capture file.
+
+    :param fp: Path to the capture file.
+    :return: Generator of (timestamp, raw bytes) tuples.
+    """
+    with gzip.open(fp, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise CaptureError('Not a capture file: [{}]'.format(fp))
+        while True:
+            try:
+                header = f.read(RECORD.size)
+                if not header:
+                    break
+                ts, n = RECORD.unpack(header)
+                data = f.read(n)
+            except (EOFError, struct.error):
+                # The capture was not closed cleanly, such as when collection crashed.
+                log.warning('Truncated capture [{}]'.format(fp))
+                break
+            if len(data) != n:
+                log.warning('Truncated capture [{}]'.format(fp))
+                break
+            yield ts, data
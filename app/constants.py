@@ -10,3 +10,8 @@ _emission_regex = r'(?P<value>-?[\d]*[\.]?[\d]+)\s?(?P<unit>[a-z]{1,4}$)'
 EMISSION_REGEX = re.compile(_emission_regex, re.IGNORECASE)
 
 UNKNOWN_UNIT = 'unknownUnit'
+
+# MT-SICS weight responses, such as 'S S      12.345 g'.  The status is
+# 'S' for a stable weight and 'D' for a dynamic (unstable) weight.
+_sics_weight_regex = r'^S\s+(?P<status>[SD])\s+(?P<value>-?[\d]*[\.]?[\d]+)\s*(?P<unit>[a-z]{1,4})$'
+SICS_WEIGHT_REGEX = re.compile(_sics_weight_regex, re.IGNORECASE)
@@ -1,3 +1,16 @@
+"""
+DAQ drivers.
+
+A driver is a thread which reads from an instrument and puts batches
+(lists) of Sample tuples onto its output queue.  Drivers subclass BaseDAQ,
+implement read(), and declare the default pyserial settings for the
+instrument they talk to.  They are looked up by name with get_driver(),
+which finds drivers registered in this module with register_driver(),
+drivers given as a 'package.module:ClassName' path, and drivers published
+by other packages under the 'datagrapher.daq' entry point group.
+"""
+import collections
+import importlib
 import logging
 import threading
 import multiprocessing
@@ -7,97 +20,194 @@ import time
 
 import serial
 
+from . import capture
 from . import constants
+from . import serial_settings
+from . import utils
 
 log = logging.getLogger(__name__)
 
+# ts is nanoseconds since the unix epoch, taken when the value was received.  value
+# is a float, parsed once by the driver, and unit is the unit the instrument reported.
+Sample = collections.namedtuple('Sample', ['ts', 'value', 'unit'], defaults=(constants.UNKNOWN_UNIT,))
 
-class MockDAQ(threading.Thread):
-    def __init__(self,
-                 serial_port_settings: dict,
-                 output_queue: multiprocessing.Queue,
-                 die_event: multiprocessing.Event,
-                 ):
-        super().__init__()
-        self.serial_port_settings = serial_port_settings
-        self.queue = output_queue
-        self.die_event = die_event
+ENTRY_POINT_GROUP = 'datagrapher.daq'
+DRIVERS = {}
 
-    def run(self):
-        log.info('{} is running!'.format(self.name))
-        while True:
-            if self.die_event.is_set():
-                log.info('[{}] Die event set'.format(self.name))
-                break
-            v = random.random()
-            log.debug('Emitting {}'.format(v))
-            self.queue.put(v)
-            time.sleep(0.3)
-            # In reality we would do non-blocking reads for line oriented data
-        log.info('[{}] is exiting'.format(self.name))
 
+class DAQError(Exception):
+    pass
+
+
+def register_driver(name):
+    """
+    Class decorator which registers a DAQ driver under a name.
+
+    :param name: Name used to select the driver.
+    :return:
+    """
+    def wrapper(cls):
+        cls.driver_name = name
+        DRIVERS[name] = cls
+        return cls
+    return wrapper
+
+
+def iter_entry_points():
+    try:
+        from importlib import metadata
+    except ImportError:
+        import pkg_resources
+        return list(pkg_resources.iter_entry_points(ENTRY_POINT_GROUP))
+    eps = metadata.entry_points()
+    if hasattr(eps, 'select'):
+        return list(eps.select(group=ENTRY_POINT_GROUP))
+    return list(eps.get(ENTRY_POINT_GROUP, []))
+
+
+def driver_names():
+    """
+    Get the names of the registered drivers and the drivers published by entry points.
+
+    :return:
+    """
+    names = set(DRIVERS)
+    names.update(ep.name for ep in iter_entry_points())
+    return sorted(names)
+
+
+def get_driver(name):
+    """
+    Find a DAQ driver class.
+
+    :param name: Registered driver name, entry point name, or 'package.module:ClassName' path.
+    :return: The driver class.
+    """
+    if name in DRIVERS:
+        return DRIVERS[name]
+    if ':' in name:
+        module_name, _, attr = name.partition(':')
+        try:
+            module = importlib.import_module(module_name)
+            return getattr(module, attr)
+        except (ImportError, AttributeError) as e:
+            raise DAQError('Unable to load DAQ driver [{}]: {}'.format(name, e))
+    for ep in iter_entry_points():
+        if ep.name == name:
+            return ep.load()
+    raise DAQError('Unknown DAQ driver [{}]. Available drivers: {}'.format(name, ', '.join(driver_names())))
+
+
+class BaseDAQ(threading.Thread):
+    """
+    Common base class for DAQ drivers.
+
+    The thread calls open() once, then calls read() and puts each non-empty
+    batch it returns onto the output queue until the die event is set, and
+    finally calls close().  read() should return within a short time (or
+    the serial timeout) so the die event is noticed.  Drivers for fast
+    instruments should return everything which is already available in one
+    batch, rather than one sample per read.
+
+    Drivers accept extra keyword arguments so that options for other
+    drivers can be passed to any of them.
+    """
+    # pyserial settings for the instrument, or None if the driver does not use a serial port.
+    default_serial_settings = None
+    driver_name = None
 
-class MockSawtoothDAQ(threading.Thread):
     def __init__(self,
                  serial_port_settings: dict,
                  output_queue: multiprocessing.Queue,
                  die_event: multiprocessing.Event,
-                 ):
+                 **kwargs):
         super().__init__()
         self.serial_port_settings = serial_port_settings
         self.queue = output_queue
         self.die_event = die_event
+        self.clock = utils.Clock()
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def read(self) -> list:
+        """
+        Read the next batch of samples.
+
+        :return: List of Sample tuples, which may be empty.
+        """
+        raise NotImplementedError
 
     def run(self):
         log.info('{} is running!'.format(self.name))
-        increment = 0.1
-        v = 0.0
-        while True:
-            if self.die_event.is_set():
-                log.info('[{}] Die event set'.format(self.name))
-                break
-            v += increment
-            log.debug('Emitting {}'.format(v))
-            self.queue.put(v)
-            time.sleep(0.3)
-            if v + increment > 1.0:
-                increment *= -1.0
-            if v + increment < - 1.0:
-                increment *= -1.0
-                # In reality we would do non-blocking reads for line oriented data
+        self.open()
+        try:
+            while True:
+                if self.die_event.is_set():
+                    log.info('[{}] Die event set'.format(self.name))
+                    break
+                batch = self.read()
+                if not batch:
+                    continue
+                log.debug('Emitting {} samples'.format(len(batch)))
+                self.queue.put(batch)
+        finally:
+            self.close()
         log.info('[{}] is exiting'.format(self.name))
 
 
-class ReplayDAQ(threading.Thread):
+@register_driver('random')
+class MockDAQ(BaseDAQ):
+    def read(self):
+        time.sleep(0.3)
+        return [Sample(self.clock.now_ns(), random.random())]
+
+
+@register_driver('sawtooth')
+class MockSawtoothDAQ(BaseDAQ):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.increment = 0.1
+        self.v = 0.0
+
+    def read(self):
+        time.sleep(0.3)
+        self.v += self.increment
+        sample = Sample(self.clock.now_ns(), self.v)
+        if self.v + self.increment > 1.0:
+            self.increment *= -1.0
+        if self.v + self.increment < - 1.0:
+            self.increment *= -1.0
+        return [sample]
+
+
+class ReplayDAQ(BaseDAQ):
     def __init__(self,
                  output_queue: multiprocessing.Queue,
                  die_event: multiprocessing.Event,
                  replay_data: list,
                  replay_rate: float =1.0,
-                 ):
-        super().__init__()
-        self.queue = output_queue
-        self.die_event = die_event
+                 **kwargs):
+        super().__init__(serial_port_settings={},
+                         output_queue=output_queue,
+                         die_event=die_event)
         self.replay_data = replay_data
         self.replay_rate = replay_rate
+        self.i = 0
 
-    def run(self):
-        log.info('{} is running!'.format(self.name))
-        i = 0
-        j = len(self.replay_data)
-        while True:
-            if self.die_event.is_set():
-                log.info('[{}] Die event set'.format(self.name))
-                break
-            v = self.replay_data[i]
-            log.debug('Emitting {}'.format(v))
-            self.queue.put(v)
-            time.sleep(self.replay_rate)
-            i = (i + 1) % j
-        log.info('[{}] is exiting'.format(self.name))
+    def read(self):
+        v = self.replay_data[self.i]
+        self.i = (self.i + 1) % len(self.replay_data)
+        sample = Sample(self.clock.now_ns(), v)
+        time.sleep(self.replay_rate)
+        return [sample]
 
 
-class MettlerNBDAQ(threading.Thread):
+@register_driver('mt-newbalance')
+class MettlerNBDAQ(BaseDAQ):
     """
     DAQ for reading in serial data from the Mettler-Toledo
     NewBalance scales.
@@ -109,67 +219,256 @@ class MettlerNBDAQ(threading.Thread):
     for use with the MT keystroke-capture software - it sends
     weird 'enter\x1b' line terminators instead of the configured
     line terminators for the balance.
+
+    If a capture_fp is given, the raw bytes of every line read are
+    written to a capture file along with their receive time, before any
+    parsing or filtering is done.
+
+    Each read returns every complete line which has already arrived, up
+    to max_batch lines, so that fast (HOST CONT) output is passed on in
+    batches.
     """
+    default_serial_settings = serial_settings.MT_NCLASSIC_DEFAULT
+
     def __init__(self,
                  serial_port_settings: dict,
                  output_queue: multiprocessing.Queue,
                  die_event: multiprocessing.Event,
-                 stable_only: bool =False):
-        super().__init__()
-        self.serial_port_settings = serial_port_settings
-        self.queue = output_queue
-        self.die_event = die_event
+                 stable_only: bool =False,
+                 capture_fp: str =None,
+                 max_batch: int =256,
+                 **kwargs):
+        super().__init__(serial_port_settings=serial_port_settings,
+                         output_queue=output_queue,
+                         die_event=die_event)
         self.stable_only = stable_only
+        self.capture_fp = capture_fp
+        self.max_batch = max_batch
         self.serial = serial.Serial()
+        self.writer = None
 
-
-    def run(self):
-        log.info('{} is running!'.format(self.name))
+    def open(self):
         # Open up the serial port
         self.serial = serial.Serial(**self.serial_port_settings)
-        while True:
-            if self.die_event.is_set():
-                log.info('[{}] Die event set'.format(self.name))
+        if self.capture_fp:
+            log.info('Capturing raw serial data to [{}]'.format(self.capture_fp))
+            self.writer = capture.CaptureWriter(self.capture_fp)
+
+    def close(self):
+        if self.writer:
+            self.writer.close()
+        log.info('Closing serial port')
+        self.serial.close()
+
+    def read(self):
+        batch = []
+        line = self.serial.readline()
+        while line:
+            # Stamp the line as soon as it is received.
+            ts = self.clock.now_ns()
+            if self.writer:
+                self.writer.write(ts, line)
+            reading = parse_line(line, stable_only=self.stable_only)
+            if reading is not None:
+                batch.append(Sample(ts, *reading))
+            if len(batch) >= self.max_batch or not self.serial.in_waiting:
                 break
             line = self.serial.readline()
-            if not line:
-                continue
-            try:
-                s = line.decode().strip()
-            except UnicodeDecodeError:
-                log.error('Failed to decode line: {}'.format(line))
-                continue
-            log.debug('Read line: [{}]'.format(s))
-            if self.stable_only:
-                # PRINTER MODE
-                # STAB - no indicator of change is included - simply no lines are printed
-                # AUTO - only the stable weights are printed regardless of interval setting.
-                # ALL - every value is printed when the interval fires
-                #     There sometimes are 'D' characters inserted on non-stable measures
-                #
-                # HOST MODE
-                # STABLE - only the stable values are printed w/ a 'S S'.
-                # CONT - Constant measurement (no rate limiting!) - with 'S S' and 'S D' included.
-                # AUTO - only stable values are printed w/ a 'S S'
-                # ALL - stable values are printed w/ a 'S S'.  Changing (unstable values) have a 'S D' in them.
-                if 'D' in s:
-                    continue
-            self.emit_value(s)
+        return batch
+
+
+@register_driver('mt-sics')
+class MettlerSICSDAQ(BaseDAQ):
+    """
+    DAQ which polls a Mettler-Toledo balance with MT-SICS commands.
+
+    In SIR mode the balance is told to send immediate weights continuously.
+    In SI mode, a window of SI requests is kept in flight: a new request is
+    sent as each response arrives, so the serial round trip time is hidden
+    and the balance is never left idle waiting for the next request.  If no
+    response arrives within the serial timeout, the outstanding requests
+    are assumed lost and the window is refilled.
+
+    The achieved readings per second are logged every report_interval
+    seconds and when the DAQ stops.
+    """
+    default_serial_settings = serial_settings.MT_SICS_DEFAULT
+
+    SIR = 'SIR'
+    SI = 'SI'
+    MODES = (SIR, SI)
+
+    def __init__(self,
+                 serial_port_settings: dict,
+                 output_queue: multiprocessing.Queue,
+                 die_event: multiprocessing.Event,
+                 stable_only: bool =False,
+                 capture_fp: str =None,
+                 sics_mode: str =SIR,
+                 sics_window: int =4,
+                 max_batch: int =256,
+                 report_interval: float =10.0,
+                 **kwargs):
+        super().__init__(serial_port_settings=serial_port_settings,
+                         output_queue=output_queue,
+                         die_event=die_event)
+        if sics_mode not in self.MODES:
+            raise DAQError('Unknown MT-SICS mode: {}'.format(sics_mode))
+        self.stable_only = stable_only
+        self.capture_fp = capture_fp
+        self.mode = sics_mode
+        self.window = max(sics_window, 1)
+        self.max_batch = max_batch
+        self.report_interval = report_interval
+        self.serial = serial.Serial()
+        self.writer = None
+        self.in_flight = 0
+        self.readings = 0
+        self.started = None
+        self.last_report = None
+        self.last_report_readings = 0
+
+    def send(self, command: str, count: int =1):
+        self.serial.write('{}\r\n'.format(command).encode() * count)
+
+    def open(self):
+        self.serial = serial.Serial(**self.serial_port_settings)
+        if self.capture_fp:
+            log.info('Capturing raw serial data to [{}]'.format(self.capture_fp))
+            self.writer = capture.CaptureWriter(self.capture_fp)
+        # Cancel anything left running from a previous session, and drop its output.
+        self.send('@')
+        time.sleep(0.1)
+        self.serial.reset_input_buffer()
+        self.started = self.last_report = time.monotonic()
+        if self.mode == self.SIR:
+            self.send(self.SIR)
+        else:
+            self.fill_window()
+
+    def fill_window(self):
+        n = self.window - self.in_flight
+        if n > 0:
+            self.send(self.SI, n)
+            self.in_flight += n
+
+    def close(self):
+        if self.mode == self.SIR:
+            # Stop the continuous output.
+            self.send('@')
+        if self.writer:
+            self.writer.close()
+        self.report()
         log.info('Closing serial port')
         self.serial.close()
-        # Close the serial port
-        log.info('[{}] is exiting'.format(self.name))
 
-    def emit_value(self, s):
-        """
-        Emits a string of data which only contains the numeric portion of the reading and any size measurements.
+    def read(self):
+        batch = []
+        line = self.serial.readline()
+        if not line and self.mode == self.SI:
+            log.warning('Timed out waiting for {} SI responses; resending.'.format(self.in_flight))
+            self.in_flight = 0
+            self.fill_window()
+        while line:
+            ts = self.clock.now_ns()
+            if self.writer:
+                self.writer.write(ts, line)
+            if self.mode == self.SI:
+                self.in_flight = max(self.in_flight - 1, 0)
+                self.fill_window()
+            reading = parse_sics_line(line, stable_only=self.stable_only)
+            if reading is not None:
+                batch.append(Sample(ts, *reading))
+            if len(batch) >= self.max_batch or not self.serial.in_waiting:
+                break
+            line = self.serial.readline()
+        self.readings += len(batch)
+        if time.monotonic() - self.last_report >= self.report_interval:
+            self.report()
+        return batch
 
-        :param s:
-        :return:
-        """
-        m = constants.EMISSION_REGEX.search(s)
-        if not m:
-            log.warning('Unable to find emission match for: [{}]'.format(s))
+    def report(self):
+        now = time.monotonic()
+        if self.started is None or now <= self.last_report:
             return
-        v = m.group()
-        self.queue.put(v)
+        rate = (self.readings - self.last_report_readings) / (now - self.last_report)
+        overall = self.readings / (now - self.started)
+        log.info('[{}] {:.1f} readings/s ({:.1f} readings/s overall, {} readings)'.format(self.name,
+                                                                                          rate,
+                                                                                          overall,
+                                                                                          self.readings))
+        self.last_report = now
+        self.last_report_readings = self.readings
+
+
+def parse_line(line: bytes, stable_only: bool =False):
+    """
+    Parse a line read from a Mettler-Toledo balance.
+
+    :param line: Raw bytes read from the balance.
+    :param stable_only: Discard values which are not stable.
+    :return: Tuple of (value, unit), or None if the line does not have a value to record.
+    """
+    try:
+        s = line.decode().strip()
+    except UnicodeDecodeError:
+        log.error('Failed to decode line: {}'.format(line))
+        return None
+    log.debug('Read line: [{}]'.format(s))
+    if stable_only:
+        # PRINTER MODE
+        # STAB - no indicator of change is included - simply no lines are printed
+        # AUTO - only the stable weights are printed regardless of interval setting.
+        # ALL - every value is printed when the interval fires
+        #     There sometimes are 'D' characters inserted on non-stable measures
+        #
+        # HOST MODE
+        # STABLE - only the stable values are printed w/ a 'S S'.
+        # CONT - Constant measurement (no rate limiting!) - with 'S S' and 'S D' included.
+        # AUTO - only stable values are printed w/ a 'S S'
+        # ALL - stable values are printed w/ a 'S S'.  Changing (unstable values) have a 'S D' in them.
+        if 'D' in s:
+            return None
+    m = constants.EMISSION_REGEX.search(s)
+    if not m:
+        log.warning('Unable to find emission match for: [{}]'.format(s))
+        return None
+    return float(m.group('value')), m.group('unit')
+
+
+def parse_sics_line(line: bytes, stable_only: bool =False):
+    """
+    Parse a MT-SICS response line.
+
+    :param line: Raw bytes read from the balance.
+    :param stable_only: Discard weights which are not stable.
+    :return: Tuple of (value, unit) of a weight response, or None if the line does not have a value to record.
+    """
+    try:
+        s = line.decode().strip()
+    except UnicodeDecodeError:
+        log.error('Failed to decode line: {}'.format(line))
+        return None
+    log.debug('Read line: [{}]'.format(s))
+    m = constants.SICS_WEIGHT_REGEX.search(s)
+    if not m:
+        # Busy (S I), overload (S +), underload (S -), errors (ES, ET, EL) and reset responses.
+        log.warning('Not a weight response: [{}]'.format(s))
+        return None
+    if stable_only and m.group('status').upper() == 'D':
+        return None
+    return float(m.group('value')), m.group('unit')
+
+
+def reprocess_capture(fp: str, stable_only: bool =False):
+    """
+    Re-parse a capture file, as fast as it can be read.
+
+    :param fp: Path to the capture file.
+    :param stable_only: Discard values which are not stable.
+    :return: Generator of Sample tuples, stamped with the original receive times.
+    """
+    for ts, line in capture.iter_capture(fp):
+        reading = parse_line(line, stable_only=stable_only)
+        if reading is not None:
+            yield Sample(ts, *reading)
@@ -0,0 +1,303 @@
+"""
+Compressed block encoding for session time series.
+
+An encoded file starts with a magic string and a JSON header (session
+metadata, the block size and the table of units), followed by blocks of up
+to block_size samples.  Within a block:
+
+* Timestamps (int64 nanoseconds) are stored as the first timestamp, the
+  first delta, and the delta-of-deltas.  Samples at a steady rate have
+  delta-of-deltas near zero.
+* Values are stored as scaled integers when every value in the block has
+  a fixed number of decimal places, as a balance reports them, using the
+  first value and the deltas.  Otherwise the XOR of each value's float64
+  bits with the previous value's bits is stored, as in Gorilla.
+* Unit codes index the header's table of units.
+
+The delta and XOR streams are zigzag encoded, narrowed to the smallest
+integer width that fits the block, and compressed with zlib.  This is a
+byte-aligned take on the Gorilla scheme, so that both directions can be
+vectorized with numpy instead of packing bits in python.  Each block
+decodes to numpy arrays on its own, so files can be streamed.
+"""
+import collections
+import json
+import logging
+import struct
+import zlib
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+MAGIC = b'DGTS1\n'
+LENGTH = struct.Struct('<I')
+# count, first ts, first ts delta, ts width, value mode, decimals, first value, value width, unit width, payload size
+BLOCK = struct.Struct('<IqqBBbqBBI')
+
+SCALED = 0
+XOR = 1
+MAX_DECIMALS = 9
+# Largest integer a float64 holds exactly.
+MAX_EXACT = 2 ** 53
+
+Block = collections.namedtuple('Block', ['ts', 'values', 'units'])
+
+
+class EncodingError(Exception):
+    pass
+
+
+def zigzag(a):
+    a = a.astype(np.int64)
+    return ((a << 1) ^ (a >> 63)).view(np.uint64)
+
+
+def unzigzag(a):
+    a = a.astype(np.uint64)
+    return ((a >> np.uint64(1)).view(np.int64)) ^ -((a & np.uint64(1)).view(np.int64))
+
+
+def narrow(a):
+    """
+    Convert unsigned integers into the narrowest unsigned dtype which holds them.
+
+    :param a: Numpy array of unsigned integers.
+    :return: Tuple of (width in bytes, bytes).
+    """
+    if not len(a):
+        return 0, b''
+    m = int(a.max())
+    for dtype in (np.uint8, np.uint16, np.uint32, np.uint64):
+        if m <= np.iinfo(dtype).max:
+            return np.dtype(dtype).itemsize, a.astype(dtype).tobytes()
+
+
+def widen(data, width, count):
+    if not count:
+        return np.zeros(0, dtype=np.uint64)
+    dtype = {1: np.uint8, 2: np.uint16, 4: np.uint32, 8: np.uint64}[width]
+    return np.frombuffer(data, dtype=dtype, count=count).astype(np.uint64)
+
+
+def find_decimals(values):
+    """
+    Find the smallest number of decimal places which exactly represents all of the values.
+
+    :param values: Numpy array of float64 values.
+    :return: Number of decimal places, or None if the values need to be XOR encoded.
+    """
+    if not np.all(np.isfinite(values)):
+        return None
+    # Scaled integers have no negative zero.
+    if np.any(np.signbit(values) & (values == 0)):
+        return None
+    for decimals in range(MAX_DECIMALS + 1):
+        scale = 10.0 ** decimals
+        scaled = np.round(values * scale)
+        if np.any(np.abs(scaled) >= MAX_EXACT):
+            return None
+        if np.array_equal(scaled / scale, values):
+            return decimals
+    return None
+
+
+def encode_block(ts, values, unit_codes):
+    """
+    Encode one block of samples.
+
+    :param ts: Numpy int64 array of timestamps.
+    :param values: Numpy float64 array of values.
+    :param unit_codes: Numpy array of indexes into the unit table.
+    :return: Bytes of the encoded block.
+    """
+    count = len(ts)
+    ts = np.asarray(ts, dtype=np.int64)
+    values = np.asarray(values, dtype=np.float64)
+    deltas = np.diff(ts)
+    first_delta = int(deltas[0]) if count > 1 else 0
+    ts_width, ts_bytes = narrow(zigzag(np.diff(deltas)))
+
+    decimals = find_decimals(values)
+    if decimals is None:
+        mode = XOR
+        decimals = 0
+        bits = values.view(np.uint64)
+        first_value = int(bits[0].view(np.int64))
+        value_width, value_bytes = narrow(bits[1:] ^ bits[:-1])
+    else:
+        mode = SCALED
+        scaled = np.round(values * 10.0 ** decimals).astype(np.int64)
+        first_value = int(scaled[0])
+        value_width, value_bytes = narrow(zigzag(np.diff(scaled)))
+
+    unit_codes = np.asarray(unit_codes, dtype=np.uint64)
+    unit_width, unit_bytes = 0, b''
+    if np.any(unit_codes):
+        unit_width, unit_bytes = narrow(unit_codes)
+
+    payload = zlib.compress(ts_bytes + value_bytes + unit_bytes)
+    header = BLOCK.pack(count, int(ts[0]), first_delta, ts_width, mode, decimals, first_value, value_width,
+                        unit_width, len(payload))
+    return header + payload
+
+
+def decode_block(header, payload):
+    """
+    Decode one block of samples.
+
+    :param header: Tuple unpacked from the BLOCK struct.
+    :param payload: Compressed payload bytes.
+    :return: Tuple of (timestamps, values, unit codes) numpy arrays.
+    """
+    count, first_ts, first_delta, ts_width, mode, decimals, first_value, value_width, unit_width, _ = header
+    data = zlib.decompress(payload)
+    offset = 0
+    n_dod = max(count - 2, 0)
+    dod = unzigzag(widen(data[offset:], ts_width, n_dod))
+    offset += n_dod * ts_width
+    deltas = np.cumsum(np.concatenate(([first_delta], dod)).astype(np.int64))[:max(count - 1, 0)]
+    ts = first_ts + np.concatenate(([0], np.cumsum(deltas))).astype(np.int64)
+
+    raw = widen(data[offset:], value_width, count - 1)
+    offset += (count - 1) * value_width
+    if mode == SCALED:
+        scaled = first_value + np.concatenate(([0], np.cumsum(unzigzag(raw)))).astype(np.int64)
+        values = scaled / 10.0 ** decimals
+    elif mode == XOR:
+        first = np.array([first_value], dtype=np.int64).view(np.uint64)
+        values = np.bitwise_xor.accumulate(np.concatenate((first, raw))).view(np.float64)
+    else:
+        raise EncodingError('Unknown value mode: {}'.format(mode))
+
+    if unit_width:
+        unit_codes = widen(data[offset:], unit_width, count).astype(np.int64)
+    else:
+        unit_codes = np.zeros(count, dtype=np.int64)
+    return ts, values, unit_codes
+
+
+class EncodedWriter(object):
+    """
+    Writes samples to an encoded file, a block at a time.
+
+    Samples passed to write() are buffered until a full block is available.
+    """
+    def __init__(self, fp: str, session: dict, units: list, block_size: int =4096):
+        """
+        :param fp: Path of the file to write.
+        :param session: JSON serializable session metadata.
+        :param units: Table of units.  Unit codes index this list.
+        :param block_size: Number of samples per block.
+        """
+        self.fp = fp
+        self.block_size = block_size
+        self.units = list(units)
+        self.f = open(fp, 'wb')
+        header = json.dumps({'session': session,
+                             'block_size': block_size,
+                             'units': self.units}).encode()
+        self.f.write(MAGIC)
+        self.f.write(LENGTH.pack(len(header)))
+        self.f.write(header)
+        self.pending = []
+        self.count = 0
+        self.size = 0
+
+    def write(self, ts, values, unit_codes):
+        """
+        Add samples to the file.
+
+        :param ts: Array of int64 timestamps.
+        :param values: Array of float64 values.
+        :param unit_codes: Array of indexes into the unit table.
+        :return:
+        """
+        self.pending.append((np.asarray(ts, dtype=np.int64),
+                             np.asarray(values, dtype=np.float64),
+                             np.asarray(unit_codes, dtype=np.int64)))
+        if sum(len(p[0]) for p in self.pending) >= self.block_size:
+            self._flush(final=False)
+
+    def _flush(self, final):
+        if not self.pending:
+            return
+        ts, values, unit_codes = (np.concatenate(a) for a in zip(*self.pending))
+        self.pending = []
+        n = len(ts)
+        end = n if final else n - n % self.block_size
+        for i in range(0, end, self.block_size):
+            j = min(i + self.block_size, end)
+            block = encode_block(ts[i:j], values[i:j], unit_codes[i:j])
+            self.f.write(block)
+            self.size += len(block)
+            self.count += j - i
+        if end < n:
+            self.pending.append((ts[end:], values[end:], unit_codes[end:]))
+
+    def close(self):
+        self._flush(final=True)
+        self.f.close()
+        log.debug('Encoded {} samples into {} bytes of blocks in [{}]'.format(self.count, self.size, self.fp))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def _read_header(f, fp):
+    if f.read(len(MAGIC)) != MAGIC:
+        raise EncodingError('Not an encoded file: [{}]'.format(fp))
+    n, = LENGTH.unpack(f.read(LENGTH.size))
+    return json.loads(f.read(n).decode())
+
+
+def read_header(fp: str) -> dict:
+    """
+    Read the JSON header of an encoded file.
+
+    :param fp: Path to the encoded file.
+    :return:
+    """
+    with open(fp, 'rb') as f:
+        return _read_header(f, fp)
+
+
+def iter_blocks(fp: str):
+    """
+    Stream the blocks of an encoded file.
+
+    :param fp: Path to the encoded file.
+    :return: Generator of Block tuples of numpy arrays.  Units are returned as an array of strings.
+    """
+    with open(fp, 'rb') as f:
+        header = _read_header(f, fp)
+        units = np.array(header.get('units') or [''], dtype=str)
+        while True:
+            raw = f.read(BLOCK.size)
+            if not raw:
+                break
+            if len(raw) != BLOCK.size:
+                raise EncodingError('Truncated block header in [{}]'.format(fp))
+            block_header = BLOCK.unpack(raw)
+            payload = f.read(block_header[-1])
+            if len(payload) != block_header[-1]:
+                raise EncodingError('Truncated block in [{}]'.format(fp))
+            ts, values, unit_codes = decode_block(block_header, payload)
+            yield Block(ts, values, units[unit_codes])
+
+
+def read_encoded(fp: str):
+    """
+    Read a whole encoded file.
+
+    :param fp: Path to the encoded file.
+    :return: Tuple of (header, Block of concatenated arrays).
+    """
+    header = read_header(fp)
+    blocks = list(iter_blocks(fp))
+    if not blocks:
+        return header, Block(np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(0, dtype=str))
+    return header, Block(*(np.concatenate(a) for a in zip(*blocks)))
@@ -0,0 +1,121 @@
+"""
+Plateau and step event detection for streaming balance data.
+
+Detection is incremental and only keeps a fixed window of recent samples,
+so it can run at the full rate of the balance.
+"""
+import collections
+import logging
+
+from . import stats
+
+log = logging.getLogger(__name__)
+
+PLATEAU = 'plateau'
+ADDED = 'added'
+REMOVED = 'removed'
+
+EventRecord = collections.namedtuple('EventRecord', ['kind', 'start', 'stop', 'mean', 'delta', 'samples'])
+
+
+class PlateauDetector(object):
+    """
+    Find periods of stable weight, and the steps between them.
+
+    A plateau starts once a full window of samples has a standard deviation
+    of no more than half of the tolerance.  It continues for as long as new
+    samples stay within the tolerance of the plateau mean.  When the plateau
+    ends, a plateau event is emitted, and the window starts again from the
+    sample which ended it, so plateaus never overlap.  When a new plateau starts at a level
+    at least min_step away from the previous plateau, a step event ('added'
+    or 'removed') is emitted covering the time between the two plateaus.
+    """
+    def __init__(self,
+                 window: int =10,
+                 tolerance: float =0.01,
+                 min_step: float =0.05):
+        self.rolling = stats.RollingStats(window=window)
+        self.times = collections.deque(maxlen=window)
+        self.tolerance = tolerance
+        self.min_step = min_step
+        self.in_plateau = False
+        self.start = None
+        self.stop = None
+        self.mean = 0.0
+        self.count = 0
+        self.transit = 0
+        self.last_mean = None
+        self.last_stop = None
+
+    def update(self, x: float, t) -> list:
+        """
+        Add a sample to the detector.
+
+        :param x: Measured value.
+        :param t: Timestamp of the measurement.  This is only stored in the events, so any comparable type works.
+        :return: A list of EventRecord tuples, which is usually empty.
+        """
+        events = []
+        if self.in_plateau:
+            if abs(x - self.mean) <= self.tolerance:
+                self.count += 1
+                self.mean += (x - self.mean) / self.count
+                self.stop = t
+                return events
+            events.append(self._close())
+        self.rolling.update(x)
+        self.times.append(t)
+        self.transit += 1
+        if len(self.rolling) == self.rolling.window and self.rolling.stddev <= self.tolerance / 2:
+            step = self._open(t)
+            if step:
+                events.append(step)
+        return events
+
+    def flush(self) -> list:
+        """
+        Close out any plateau which is in progress.
+
+        :return: A list of EventRecord tuples.
+        """
+        if self.in_plateau:
+            return [self._close()]
+        return []
+
+    def _open(self, t):
+        self.in_plateau = True
+        self.start = self.times[0]
+        self.stop = t
+        self.mean = self.rolling.mean
+        self.count = len(self.rolling)
+        step = None
+        if self.last_mean is not None:
+            delta = self.mean - self.last_mean
+            if abs(delta) >= self.min_step:
+                step = EventRecord(kind=ADDED if delta > 0 else REMOVED,
+                                   start=self.last_stop,
+                                   stop=self.start,
+                                   mean=self.mean,
+                                   delta=delta,
+                                   samples=max(self.transit - self.count, 0))
+        self.transit = 0
+        return step
+
+    def _close(self):
+        delta = None
+        if self.last_mean is not None:
+            delta = self.mean - self.last_mean
+        event = EventRecord(kind=PLATEAU,
+                            start=self.start,
+                            stop=self.stop,
+                            mean=self.mean,
+                            delta=delta,
+                            samples=self.count)
+        self.in_plateau = False
+        self.last_mean = self.mean
+        self.last_stop = self.stop
+        # The window only holds samples from the plateau which just ended.  A new
+        # plateau must be found from later samples, or the two would overlap.
+        self.rolling.clear()
+        self.times.clear()
+        return event
@@ -0,0 +1,303 @@
+"""
+Export of session data to files, in parallel.
+
+Sessions are exported by a pool of worker processes.  Each worker opens its
+own read-only sqlite3 connection.  Databases are kept in WAL mode, so the
+workers can read while a collection is writing to the database.  CSV output
+is streamed to the file a batch of rows, or an archive block, at a time;
+xlsx output is built with pandas, which is only imported when it is needed.
+Sessions which have been archived by the maintain command are read from
+their archive.
+"""
+import concurrent.futures
+import csv
+import itertools
+import logging
+import os
+import pathlib
+import sqlite3
+import time
+
+import numpy as np
+from sqlalchemy import DateTime, or_, select
+
+from . import encoding
+from . import maintenance
+from . import model
+
+log = logging.getLogger(__name__)
+
+CSV = 'csv'
+XLSX = 'xlsx'
+FORMATS = (CSV, XLSX)
+
+
+def data_columns():
+    """
+    Get the logdata columns which are exported.
+
+    The row id is left out, since archives do not keep it, so that a session
+    exports the same columns whether or not it has been archived.
+
+    :return: List of column names.
+    """
+    return [c.name for c in model.LogData.__table__.columns if c.name != 'id']
+
+
+class ExportError(Exception):
+    pass
+
+
+def parse_ids(specs):
+    """
+    Parse session id arguments into ranges of session ids.
+
+    Ranges are kept as ranges, rather than expanded into every id, so that a
+    large range is a single BETWEEN condition in the query.
+
+    :param specs: Iterable of strings.  Each is an id ('5'), an inclusive range ('5-9') or a comma separated list of
+    either ('1,3,5-9').
+    :return: Sorted list of non-overlapping (low, high) inclusive ranges.
+    """
+    ranges = []
+    for spec in specs:
+        for part in str(spec).split(','):
+            part = part.strip()
+            if not part:
+                continue
+            try:
+                if '-' in part:
+                    lo, hi = (int(v) for v in part.split('-', 1))
+                    if lo > hi:
+                        raise ExportError('Invalid session id range: {}'.format(part))
+                else:
+                    lo = hi = int(part)
+            except ValueError:
+                raise ExportError('Invalid session id: {}'.format(part))
+            ranges.append((lo, hi))
+    merged = []
+    for lo, hi in sorted(ranges):
+        if merged and lo <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(hi, merged[-1][1]))
+        else:
+            merged.append((lo, hi))
+    return merged
+
+
+def select_sessions(fp, id_ranges=None, since=None):
+    """
+    Find the sessions to export.
+
+    :param fp: Path to the database.
+    :param id_ranges: Optional list of (low, high) inclusive ranges of session ids, from parse_ids().
+    :param since: Optional datetime; only sessions started at or after this time are selected.
+    :return: List of (id, name, start, stop) rows.
+    """
+    t = model.LogSession.__table__
+    q = select([t.c.id, t.c.name, t.c.start, t.c.stop])
+    if id_ranges:
+        q = q.where(or_(*[t.c.id.between(lo, hi) for lo, hi in id_ranges]))
+    if since is not None:
+        q = q.where(t.c.start >= since)
+    q = q.order_by(t.c.id)
+    engine = model.get_engine(fp)
+    with engine.connect() as conn:
+        return conn.execute(q).fetchall()
+
+
+def connect_readonly(fp: str) -> sqlite3.Connection:
+    uri = '{}?mode=ro'.format(pathlib.Path(fp).resolve().as_uri())
+    return sqlite3.connect(uri, uri=True)
+
+
+def output_name(row, fmt: str, events: bool =False) -> str:
+    """
+    Get the default file name for an exported session.
+
+    :param row: (id, name, start, stop) row for the session.
+    :param fmt: Output format.
+    :param events: If the events are being exported.
+    :return:
+    """
+    _, name, start, stop = row
+    suffix = '_events' if events else ''
+    return '{}_{}_{}{}.{}'.format(name, start, stop, suffix, fmt)
+
+
+def _archive_batches(archive, session_id):
+    """
+    Stream the rows of a session archive, one encoded block at a time.
+
+    The difference column is recomputed from the values the same way the serializer computes it.
+
+    :param archive: Path to the archive.
+    :param session_id: LogSession id, used for the session_id column.
+    :return: Generator of lists of rows, with the columns from data_columns().
+    """
+    names = data_columns()
+    previous = 0.0
+    for block in encoding.iter_blocks(archive):
+        if not len(block.ts):
+            continue
+        # Match the timestamp strings SQLAlchemy stores in the database.
+        stamps = np.datetime_as_string(block.ts.astype('datetime64[ns]').astype('datetime64[us]'))
+        columns = {'data': block.values,
+                   'difference': np.diff(block.values, prepend=previous),
+                   'unit': block.units,
+                   'timestamp': np.char.replace(stamps, 'T', ' '),
+                   'ts': block.ts,
+                   'session_id': np.full(len(block.ts), session_id, dtype=np.int64)}
+        previous = block.values[-1]
+        yield list(zip(*(columns.get(name).tolist() for name in names)))
+
+
+def _write_csv(fp, header, batches):
+    rows = 0
+    with open(fp, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        for batch in batches:
+            writer.writerows(batch)
+            rows += len(batch)
+    return rows
+
+
+def _iter_fetch(cursor, batch_size):
+    while True:
+        batch = cursor.fetchmany(batch_size)
+        if not batch:
+            break
+        yield batch
+
+
+def export_session(db: str,
+                   session_id: int,
+                   fp: str,
+                   fmt: str =CSV,
+                   events: bool =False,
+                   archive: str =None,
+                   batch_size: int =10000):
+    """
+    Export the data for a single session to a file.  This is run in the worker processes.
+
+    :param db: Path to the database.
+    :param session_id: LogSession id to export.
+    :param fp: Path of the file to write.
+    :param fmt: Output format, CSV or XLSX.
+    :param events: Export the session's events instead of its data.
+    :param archive: Path to the session's archive, if it has been archived.
+    :param batch_size: Number of rows fetched from the database at a time.
+    :return: Tuple of (session id, path written, number of rows).  The path is None if there were no rows.
+    """
+    table = model.LogEvent.__table__ if events else model.LogData.__table__
+    if archive and not events:
+        batches = _archive_batches(archive, session_id)
+        first = next(batches, None)
+        if first is None:
+            return session_id, None, 0
+        header = data_columns()
+        if fmt == CSV:
+            rows = _write_csv(fp, header, itertools.chain([first], batches))
+        else:
+            import pandas
+            df = pandas.DataFrame(list(itertools.chain(first, *batches)), columns=header)
+            df['timestamp'] = pandas.to_datetime(df['timestamp'])
+            df.to_excel(fp, index=False)
+            rows = len(df)
+        return session_id, fp, rows
+
+    names = [c.name for c in table.columns] if events else data_columns()
+    sql = 'SELECT {} FROM {} WHERE session_id = ? ORDER BY id'.format(', '.join('"{}"'.format(n) for n in names),
+                                                                     table.name)
+    conn = connect_readonly(db)
+    try:
+        if fmt == CSV:
+            cursor = conn.execute(sql, (session_id,))
+            batch = cursor.fetchmany(batch_size)
+            if not batch:
+                return session_id, None, 0
+            header = [d[0] for d in cursor.description]
+            rows = _write_csv(fp, header, itertools.chain([batch], _iter_fetch(cursor, batch_size)))
+        else:
+            import pandas
+            dates = [c.name for c in table.columns if isinstance(c.type, DateTime)]
+            df = pandas.read_sql_query(sql, conn, params=(session_id,), parse_dates=dates)
+            if df.empty:
+                return session_id, None, 0
+            df.to_excel(fp, index=False)
+            rows = len(df)
+    finally:
+        conn.close()
+    return session_id, fp, rows
+
+
+def export_sessions(db: str,
+                    sessions: list,
+                    output_dir: str ='.',
+                    fmt: str =CSV,
+                    events: bool =False,
+                    jobs: int =None,
+                    batch_size: int =10000,
+                    output: str =None):
+    """
+    Export sessions in parallel, each to its own file.
+
+    :param db: Path to the database.
+    :param sessions: List of (id, name, start, stop) rows, from select_sessions().
+    :param output_dir: Directory to write the files into.
+    :param fmt: Output format, CSV or XLSX.
+    :param events: Export the sessions' events instead of their data.
+    :param jobs: Number of worker processes.  Defaults to the number of CPUs.
+    :param batch_size: Number of rows fetched from the database at a time.
+    :param output: File name to use when exporting a single session.
+    :return: Tuple of (list of (session id, path, rows) results, total rows, elapsed seconds).
+    """
+    if fmt not in FORMATS:
+        raise ExportError('Unknown format: {}'.format(fmt))
+    if output and len(sessions) > 1:
+        raise ExportError('An output file can only be given when exporting a single session.')
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    mode = model.enable_wal(model.get_engine(db))
+    if mode != 'wal':
+        log.warning('Database is in {} mode; the export may wait on, or hold up, a collection.'.format(mode))
+    archived = maintenance.archived_sessions(db)
+    tasks = []
+    for row in sessions:
+        fp = output or os.path.join(output_dir, output_name(row, fmt, events=events))
+        archive = archived.get(row[0], {}).get('path')
+        tasks.append(dict(db=db,
+                          session_id=row[0],
+                          fp=fp,
+                          fmt=fmt,
+                          events=events,
+                          archive=archive,
+                          batch_size=batch_size))
+    results = []
+    start = time.monotonic()
+    if len(tasks) == 1 or jobs == 1:
+        # Not worth starting worker processes for.
+        for task in tasks:
+            results.append(_log_result(export_session(**task)))
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(export_session, **task) for task in tasks]
+            for future in concurrent.futures.as_completed(futures):
+                results.append(_log_result(future.result()))
+    elapsed = time.monotonic() - start
+    rows = sum(r[2] for r in results)
+    log.info('Exported {} rows from {} sessions in {:.3f}s ({:.1f} rows/s)'.format(rows,
+                                                                                len(results),
+                                                                                elapsed,
+                                                                                rows / elapsed if elapsed else 0.0))
+    results.sort()
+    return results, rows, elapsed
+
+
+def _log_result(result):
+    session_id, fp, rows = result
+    if fp is None:
+        log.warning('No rows found for id: {}'.format(session_id))
+    else:
+        log.info('Wrote {} rows for id {} to [{}]'.format(rows, session_id, fp))
+    return result
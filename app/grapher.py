@@ -8,7 +8,7 @@ import numpy as np
 from vispy import gloo
 from vispy import app
 
-from . import constants
+from . import stats
 
 log = logging.getLogger(__name__)
 
@@ -89,31 +89,32 @@ void main() {
 """
 
 
-class Canvas(app.Canvas):
-    def __init__(self,
-                 output_queue: multiprocessing.Queue,
-                 n: int,
-                 close_event: multiprocessing.Event):
-        # Setup stuff
-        self.queue = output_queue
-        self.close_event = close_event
+class SignalCanvas(app.Canvas):
+    """
+    Base canvas which draws a grid of signals with the realtime signals shaders.
+
+    Subclasses set up self.graph_data, with one row per signal, and call
+    self.setup_program().
+    """
+    def setup_program(self, nrows: int, ncols: int, n: int):
+        """
+        Build the shader program for graph_data laid out on a nrows by ncols grid.
+
+        Signals fill the grid column by column; any unused cells are left empty.
+
+        :param nrows: Number of rows in the grid.
+        :param ncols: Number of columns in the grid.
+        :param n: Number of samples per signal.
+        :return:
+        """
+        self.nrows = nrows
+        self.ncols = ncols
         self.n = n
-        self.nrows = 2
-        self.ncols = 1
-        self.m = self.nrows * self.ncols
-        self.lock = multiprocessing.Lock()
-        self.input_data = np.zeros(shape=self.n)
-        self.diff_data = np.zeros(shape=self.n)
-        self.scaled_input_data = np.zeros(shape=self.n)
-        self.scaled_diff_data = np.zeros(shape=self.n)
-        self.graph_data = np.stack((self.diff_data, self.input_data)).astype(np.float32)
-        # noinspection PyTypeChecker
-        self.index = np.c_[np.repeat(np.repeat(np.arange(self.ncols), self.nrows), self.n),
-                           np.repeat(np.tile(np.arange(self.nrows), self.ncols), self.n),
-                           np.tile(np.arange(self.n), self.m)].astype(np.float32)
+        m = self.graph_data.shape[0]
+        self.index = signal_index(nrows, ncols, n)[:m * n]
         # These colors should be fixed colors!
-        self.color = np.repeat(np.random.uniform(size=(self.m, 3), low=.5, high=.9),
-                               self.n,
+        self.color = np.repeat(np.random.uniform(size=(m, 3), low=.5, high=.9),
+                               n,
                                axis=0).astype(np.float32)
         # Build the app.Canvas and  set variables
         app.Canvas.__init__(self, title='Use your wheel to zoom!',
@@ -124,16 +125,13 @@ class Canvas(app.Canvas):
         self.program['a_color'] = self.color
         self.program['a_index'] = self.index
         self.program['u_scale'] = (1., 1.)
-        self.program['u_size'] = (self.nrows, self.ncols)
+        self.program['u_size'] = (nrows, ncols)
         self.program['u_n'] = n
 
         gloo.set_viewport(0, 0, *self.physical_size)
 
-        self._timer = app.Timer(connect=self.on_timer, start=True)
-
         gloo.set_state(clear_color='black', blend=True,
                        blend_func=('src_alpha', 'one_minus_src_alpha'))
-        self.show()
 
     def on_resize(self, event):
         gloo.set_viewport(0, 0, *event.physical_size)
@@ -146,6 +144,44 @@ class Canvas(app.Canvas):
         self.program['u_scale'] = (max(1, scale_x_new), max(1, scale_y_new))
         self.update()
 
+    # noinspection PyUnusedLocal
+    def on_draw(self, event):
+        gloo.clear()
+        self.program.draw('line_strip')
+
+    # noinspection PyUnusedLocal
+    def on_close(self, event):
+        log.debug('Close event found.')
+        self.close_event.set()
+
+
+class Canvas(SignalCanvas):
+    def __init__(self,
+                 output_queue: multiprocessing.Queue,
+                 n: int,
+                 close_event: multiprocessing.Event,
+                 show_stats: bool =True,
+                 stats_window: int =30,
+                 ewma_alpha: float =0.1):
+        # Setup stuff
+        self.queue = output_queue
+        self.close_event = close_event
+        self.n = n
+        self.show_stats = show_stats
+        self.stats = stats.StreamingStats(window=stats_window, alpha=ewma_alpha)
+        self.lock = multiprocessing.Lock()
+        self.input_data = np.zeros(shape=self.n)
+        self.diff_data = np.zeros(shape=self.n)
+        self.ewma_data = np.zeros(shape=self.n)
+        self.stddev_data = np.zeros(shape=self.n)
+        self.drift_data = np.zeros(shape=self.n)
+        self.graph_data = self._stack_rows()
+        # The smoothed weight, rolling stddev and drift rate get their own rows below the difference.
+        self.setup_program(nrows=self.graph_data.shape[0], ncols=1, n=n)
+
+        self._timer = app.Timer(connect=self.on_timer, start=True)
+        self.show()
+
     # noinspection PyUnusedLocal
     def on_timer(self, event):
         """
@@ -153,49 +189,131 @@ class Canvas(app.Canvas):
         :param event:
         :return:
         """
+        updated = False
         while True:
             try:
                 v = self.queue.get(block=False)
             except queue.Empty:
                 break
             self.update_array(v)
+            updated = True
+        if updated:
             with self.lock:
                 self.program['a_position'].set_data(self.graph_data.ravel().astype(np.float32))
         self.update()
 
-    # noinspection PyUnusedLocal
-    def on_draw(self, event):
-        gloo.clear()
-        self.program.draw('line_strip')
-
-    # noinspection PyUnusedLocal
-    def on_close(self, event):
-        log.debug('Close event found.')
-        self.close_event.set()
-
-    def update_array(self, v):
+    def update_array(self, batch):
         """
-        Append a value to the end of the numpy array and update
+        Append a batch of values to the end of the numpy array and update
         the difference array.
 
-        :param v:
+        :param batch: List of daq.Sample tuples.
         :return:
         """
-        k = 1
-        if isinstance(v, str):
-            m = constants.FLOAT_REGEX.search(v)
-            if not m:
-                log.error('Cannot find a numeric like value in: {}'.format())
-                raise ValueError('Bad value encountered')
-            v = float(m.group())
+        values = [sample.value for sample in batch]
+        if not values:
+            return
+        # Only the newest n values are visible.
+        k = min(len(values), self.n)
         with self.lock:
-            self.input_data[:-k] = self.input_data[k:]
-            self.input_data[-k:] = v
+            shift(self.input_data, values[-k:])
             self.diff_data = np.diff(self.input_data)
             # lol its like leftpad
             self.diff_data = np.insert(self.diff_data, 0, self.diff_data[0])
-            # Now normalize the data
-            # http://stackoverflow.com/questions/1735025/how-to-normalize-a-numpy-array-to-within-a-certain-range
-            self.scaled_diff_data = self.diff_data / np.max(np.abs(self.diff_data))
-            self.scaled_input_data = self.input_data / np.max(np.abs(self.input_data))
-            self.graph_data = np.stack((self.scaled_diff_data, self.scaled_input_data)).astype(np.float32)
+            if self.show_stats:
+                # Every sample goes through the stats, even ones which are not visible.
+                samples = [self.stats.update(v, sample.ts / 1e9) for sample, v in zip(batch, values)]
+                shift(self.ewma_data, [sample.ewma for sample in samples[-k:]])
+                shift(self.stddev_data, [sample.stddev for sample in samples[-k:]])
+                shift(self.drift_data, [sample.slope for sample in samples[-k:]])
+            self.graph_data = self._stack_rows()
+
+    def _stack_rows(self):
+        """
+        Normalize each signal and stack them into the rows drawn by the shader.
+
+        Row zero is drawn at the bottom of the window.
+
+        :return:
+        """
+        rows = [self.diff_data, self.input_data]
+        if self.show_stats:
+            rows = [self.drift_data, self.stddev_data, self.ewma_data] + rows
+        # Now normalize the data
+        # http://stackoverflow.com/questions/1735025/how-to-normalize-a-numpy-array-to-within-a-certain-range
+        rows = [normalize(row) for row in rows]
+        return np.stack(rows).astype(np.float32)
+
+
+def shift(a, values):
+    """
+    Shift an array to the left in place, and put values onto the end of it.
+
+    :param a: Numpy array.
+    :param values: Sequence of values, no longer than a.
+    :return:
+    """
+    k = len(values)
+    a[:-k] = a[k:]
+    a[-k:] = values
+
+
+def normalize(a):
+    """
+    Scale an array into the range [-1, 1].
+
+    :param a: Numpy array.
+    :return:
+    """
+    m = np.max(np.abs(a))
+    if not m:
+        return a
+    return a / m
+
+
+
+class SessionCanvas(SignalCanvas):
+    """
+    Static view of several sessions at once.
+
+    Each session is drawn in its own cell of the grid, resampled onto a
+    common axis of time since the start of the session, so the runs line up
+    with each other.  Sessions shorter than the longest one hold their last
+    value.  All of the sessions share one vertical scale.
+    """
+    def __init__(self,
+                 signals: list,
+                 n: int,
+                 close_event: multiprocessing.Event):
+        """
+        :param signals: List of (relative time, value) numpy array pairs, one per session.
+        :param n: Number of points to resample each session onto.
+        :param close_event: Event set when the window is closed.
+        """
+        self.close_event = close_event
+        self.lock = multiprocessing.Lock()
+        duration = max(t[-1] for t, v in signals)
+        grid = np.linspace(0.0, duration, n)
+        rows = [np.interp(grid, t, v) for t, v in signals]
+        self.graph_data = normalize(np.stack(rows)).astype(np.float32)
+        m = len(signals)
+        ncols = int(math.ceil(math.sqrt(m)))
+        nrows = int(math.ceil(m / ncols))
+        self.setup_program(nrows=nrows, ncols=ncols, n=n)
+        self.show()
+
+
+def signal_index(nrows, ncols, n):
+    """
+    Build the (col, row, time) index used by the vertex shader.
+
+    :param nrows: Number of rows in the grid.
+    :param ncols: Number of columns in the grid.
+    :param n: Number of samples per signal.
+    :return:
+    """
+    m = nrows * ncols
+    # noinspection PyTypeChecker
+    return np.c_[np.repeat(np.repeat(np.arange(ncols), nrows), n),
+                 np.repeat(np.tile(np.arange(nrows), ncols), n),
+                 np.tile(np.arange(n), m)].astype(np.float32)
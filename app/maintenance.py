@@ -0,0 +1,292 @@
+"""
+Retention, archival and compaction of the SQLite database.
+
+Old sessions are archived into per-session block encoded files, then
+their raw rows are removed from the live database in small batches so the
+database is never locked for long.  The session, and its events, stay in
+the live database so they still show up in the list command.
+"""
+import datetime
+import logging
+import os
+
+from sqlalchemy import func, select
+
+from . import encoding
+from . import model
+from . import utils
+
+log = logging.getLogger(__name__)
+
+ARCHIVE_COMPONENT = 'archive'
+AUTO_VACUUM_INCREMENTAL = 2
+
+
+class MaintenanceError(Exception):
+    pass
+
+
+def archived_sessions(fp):
+    """
+    Get the archive records for sessions which have already been archived.
+
+    :param fp: Path to the database.
+    :return: Dictionary of session id to archive record.
+    """
+    with model.session_scope(fp) as s:
+        r = s.query(model.State).filter_by(component=ARCHIVE_COMPONENT).all()
+        return {int(row.key): row.value for row in r}
+
+
+def sessions_older_than(fp, cutoff):
+    """
+    Find sessions which stopped before the cutoff and have not been archived.
+
+    :param fp: Path to the database.
+    :param cutoff: datetime object.
+    :return: List of LogSession ids.
+    """
+    archived = archived_sessions(fp)
+    with model.session_scope(fp) as s:
+        r = s.query(model.LogSession.id) \
+            .filter(model.LogSession.stop != None) \
+            .filter(model.LogSession.stop < cutoff) \
+            .order_by(model.LogSession.id) \
+            .all()
+    return [row.id for row in r if row.id not in archived]
+
+
+def archive_session(fp, session_id, archive_dir, block_size=4096):
+    """
+    Write the data for a session into a compressed archive file.
+
+    The archive is not recorded in the State table; see record_archive().
+
+    The rows are streamed out of the database a block at a time and written
+    with the block encoding from the encoding module.
+
+    :param fp: Path to the database.
+    :param session_id: LogSession id to archive.
+    :param archive_dir: Directory to write the archive into.
+    :param block_size: Number of samples per encoded block.
+    :return: The archive record.
+    """
+    with model.session_scope(fp) as s:
+        ls = s.query(model.LogSession).filter_by(id=session_id).one()
+        session = {k: str(v) if isinstance(v, datetime.datetime) else v
+                   for k, v in model.row2dict(ls).items()}
+    t = model.LogData.__table__
+    if not os.path.isdir(archive_dir):
+        os.makedirs(archive_dir)
+    path = os.path.join(archive_dir, 'session_{}.dgts'.format(session_id))
+    engine = model.get_engine(fp)
+    with engine.connect() as conn:
+        q = select([t.c.unit]).where(t.c.session_id == session_id).distinct()
+        units = [row[0] or '' for row in conn.execute(q)]
+        codes = {unit: i for i, unit in enumerate(units)}
+        # Rows without a timestamp are archived with a ts of 0, so the archive keeps every row.
+        q = select([func.coalesce(t.c.ts, 0), t.c.data, t.c.unit]) \
+            .where(t.c.session_id == session_id) \
+            .order_by(t.c.id)
+        result = conn.execute(q)
+        with encoding.EncodedWriter(path, session=session, units=units, block_size=block_size) as writer:
+            while True:
+                rows = result.fetchmany(block_size)
+                if not rows:
+                    break
+                ts, data, unit = zip(*rows)
+                writer.write(ts, data, [codes[u or ''] for u in unit])
+    record = {'path': path,
+              'rows': writer.count,
+              'bytes': os.path.getsize(path),
+              'archived': str(utils.now())}
+    log.info('Archived {} rows for session {} to [{}] ({} bytes)'.format(record.get('rows'),
+                                                                         session_id,
+                                                                         path,
+                                                                         record.get('bytes')))
+    return record
+
+
+def record_archive(fp, session_id, record):
+    """
+    Record the archive for a session in the State table.
+
+    Once a session has an archive record, it is read from its archive and its live rows may be deleted.
+
+    :param fp: Path to the database.
+    :param session_id: LogSession id.
+    :param record: Archive record from archive_session().
+    :return:
+    """
+    with model.session_scope(fp, commit=True) as s:
+        s.merge(model.State(ARCHIVE_COMPONENT, str(session_id), record))
+
+
+def count_session_rows(fp, table, session_id):
+    engine = model.get_engine(fp)
+    q = select([func.count()]).select_from(table).where(table.c.session_id == session_id)
+    with engine.connect() as conn:
+        return conn.execute(q).scalar()
+
+
+def sessions_pending_delete(fp):
+    """
+    Find archived sessions which still have rows in the live database, such as when deleting them was interrupted.
+
+    :param fp: Path to the database.
+    :return: List of LogSession ids.
+    """
+    t = model.LogData.__table__
+    engine = model.get_engine(fp)
+    pending = []
+    with engine.connect() as conn:
+        for session_id in sorted(archived_sessions(fp)):
+            # A single index lookup per session, rather than counting its rows.
+            q = select([t.c.id]).where(t.c.session_id == session_id).limit(1)
+            if conn.execute(q).first() is not None:
+                pending.append(session_id)
+    return pending
+
+
+def delete_session(fp, session_id, batch_size=10000):
+    """
+    Delete the raw data and statistics for an archived session from the live database.
+
+    :param fp: Path to the database.
+    :param session_id: LogSession id.
+    :param batch_size: Number of rows to delete per transaction.
+    :return: Number of logdata rows deleted.
+    """
+    deleted = delete_session_rows(fp, model.LogData.__table__, session_id, batch_size=batch_size)
+    # The statistics can be recomputed from the archived data.
+    delete_session_rows(fp, model.LogStats.__table__, session_id, batch_size=batch_size)
+    return deleted
+
+
+def archive_path(fp, session_id):
+    """
+    Get the archive path for a session, if it has been archived.
+
+    :param fp: Path to the database.
+    :param session_id: LogSession id.
+    :return: Path to the archive, or None.
+    """
+    record = archived_sessions(fp).get(session_id)
+    if record:
+        return record.get('path')
+    return None
+
+
+def load_session_arrays(fp, session_id):
+    """
+    Bulk load the data for a session into numpy arrays, from its archive if it has been archived.
+
+    :param fp: Path to the database.
+    :param session_id: LogSession id to load.
+    :return: Tuple of (seconds since the first sample, data values) numpy arrays.
+    """
+    path = archive_path(fp, session_id)
+    if not path:
+        return model.load_session_arrays(fp, session_id)
+    _, block = encoding.read_encoded(path)
+    # Rows without a timestamp are archived with a ts of 0; leave them out, as model.load_session_arrays() does.
+    keep = block.ts != 0
+    times = block.ts[keep]
+    if len(times):
+        times = (times - times[0]) / 1e9
+    return times, block.values[keep]
+
+
+def delete_session_rows(fp, table, session_id, batch_size=10000):
+    """
+    Delete the rows for a session from a table, committing after each batch.
+
+    :param fp: Path to the database.
+    :param table: SQLAlchemy Table object with a session_id column.
+    :param session_id: LogSession id to delete rows for.
+    :param batch_size: Number of rows to delete per transaction.
+    :return: Number of rows deleted.
+    """
+    engine = model.get_engine(fp)
+    ids = select([table.c.id]).where(table.c.session_id == session_id).limit(batch_size)
+    deleted = 0
+    while True:
+        with engine.begin() as conn:
+            r = conn.execute(table.delete().where(table.c.id.in_(ids)))
+        if not r.rowcount:
+            break
+        deleted += r.rowcount
+        log.debug('Deleted {} rows from {} for session {}'.format(deleted, table.name, session_id))
+    return deleted
+
+
+def vacuum(fp, full=False):
+    """
+    Return free pages in the database to the filesystem.
+
+    Databases made with auto_vacuum=INCREMENTAL are vacuumed incrementally.
+    Older databases need a single full VACUUM to switch them over, which
+    locks the database for its duration, so it is only done if requested.
+
+    :param fp: Path to the database.
+    :param full: Convert the database to incremental auto vacuum with a full VACUUM if needed.
+    :return: True if the database was vacuumed.
+    """
+    engine = model.get_engine(fp)
+    with engine.connect() as conn:
+        mode = conn.execute('PRAGMA auto_vacuum').scalar()
+        if mode == AUTO_VACUUM_INCREMENTAL:
+            free = conn.execute('PRAGMA freelist_count').scalar()
+            log.info('Incremental vacuum of {} free pages'.format(free))
+            # Stepping the pragma through the DB API only frees one page per step; executescript runs it to completion.
+            conn.connection.executescript('PRAGMA incremental_vacuum')
+            log.info('{} free pages remain'.format(conn.execute('PRAGMA freelist_count').scalar()))
+            return True
+        if not full:
+            log.warning('Database does not use incremental auto vacuum; use --full-vacuum to convert it.')
+            return False
+        log.info('Converting database to incremental auto vacuum; this may take a while.')
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        conn.execute('VACUUM')
+    return True
+
+
+def maintain(fp, older_than, archive_dir, batch_size=10000, full_vacuum=False, dry_run=False):
+    """
+    Archive sessions older than a number of days, remove their raw data from the database and vacuum it.
+
+    :param fp: Path to the database.
+    :param older_than: Age of sessions to archive, in days.
+    :param archive_dir: Directory to write the archives into.
+    :param batch_size: Number of rows to delete per transaction.
+    :param full_vacuum: Allow a full VACUUM to convert the database to incremental auto vacuum.
+    :param dry_run: Only report the sessions which would be archived.
+    :return: Tuple of (archived session ids, bytes reclaimed).
+    """
+    if not os.path.isfile(fp):
+        raise MaintenanceError('DB is not a file. [{}]'.format(fp))
+    model.upgrade_db(fp)
+    before = os.path.getsize(fp)
+    cutoff = utils.now() - datetime.timedelta(days=older_than)
+    session_ids = sessions_older_than(fp, cutoff)
+    log.info('Found {} sessions which stopped before {}'.format(len(session_ids), cutoff))
+    pending = sessions_pending_delete(fp)
+    if pending:
+        log.info('Found {} archived sessions which still have rows to delete: {}'.format(len(pending), pending))
+    if dry_run:
+        return session_ids, 0
+    for session_id in pending:
+        delete_session(fp, session_id, batch_size=batch_size)
+    for session_id in session_ids:
+        record = archive_session(fp, session_id, archive_dir)
+        # Check the archive before anything is deleted, so a bad archive leaves the live data in place.
+        rows = count_session_rows(fp, model.LogData.__table__, session_id)
+        if rows != record.get('rows'):
+            raise MaintenanceError('Archived {} rows but found {} rows for session {}'.format(record.get('rows'),
+                                                                                             rows,
+                                                                                             session_id))
+        record_archive(fp, session_id, record)
+        delete_session(fp, session_id, batch_size=batch_size)
+    vacuum(fp, full=full_vacuum)
+    after = os.path.getsize(fp)
+    return session_ids, before - after
@@ -0,0 +1,144 @@
+"""
+Lightweight schema migrations for existing databases.
+
+The schema version is stored in the State table.  Each migration is a
+function which takes a SQLAlchemy connection, and is applied inside of a
+transaction along with the version bump.  New databases are created from
+the models with the latest schema and are stamped with the latest version.
+Migrations must be safe to run against a database where create_all() has
+already made the objects they add.  Migrations which rewrite large tables
+are batched, committing after each batch of rows so the database is never
+locked for long, and are safe to restart if they are interrupted.
+"""
+import json
+import logging
+
+log = logging.getLogger(__name__)
+
+SCHEMA_COMPONENT = 'schema'
+VERSION_KEY = 'version'
+
+BATCH_SIZE = 100000
+
+MIGRATIONS = []
+
+
+def migration(func):
+    """
+    Decorator which registers a migration.  Migrations are applied in the order they are registered.
+
+    :param func: Function taking a SQLAlchemy connection.
+    :return:
+    """
+    MIGRATIONS.append(func)
+    return func
+
+
+def batched_migration(func):
+    """
+    Decorator which registers a batched migration.
+
+    The function is called repeatedly, each time in its own transaction, as
+    func(conn, after_id, batch_size).  after_id is None on the first call.  It
+    returns the last id it processed, or None once it is finished.
+
+    :param func: Function taking a SQLAlchemy connection, the last id processed and the batch size.
+    :return:
+    """
+    func.batched = True
+    MIGRATIONS.append(func)
+    return func
+
+
+def latest_version():
+    return len(MIGRATIONS)
+
+
+def get_version(conn):
+    row = conn.execute('SELECT _value FROM state WHERE component = ? AND key = ?',
+                       (SCHEMA_COMPONENT, VERSION_KEY)).fetchone()
+    if row is None:
+        return 0
+    return json.loads(row[0])
+
+
+def set_version(conn, version):
+    # The values in the State table are json encoded.
+    conn.execute('INSERT OR REPLACE INTO state (component, key, _value) VALUES (?, ?, ?)',
+                 (SCHEMA_COMPONENT, VERSION_KEY, json.dumps(version)))
+
+
+def column_names(conn, table):
+    return [row[1] for row in conn.execute('PRAGMA table_info({})'.format(table))]
+
+
+def migrate(engine):
+    """
+    Apply any migrations which have not been applied to a database.
+
+    :param engine: SQLAlchemy engine.
+    :return: The schema version of the database.
+    """
+    with engine.begin() as conn:
+        version = get_version(conn)
+    for i, func in enumerate(MIGRATIONS[version:], start=version + 1):
+        if getattr(func, 'batched', False):
+            log.warning('Applying migration {}: {}.  This may take a while on a large database.'.format(i,
+                                                                                                   func.__name__))
+            after_id = None
+            while True:
+                with engine.begin() as conn:
+                    after_id = func(conn, after_id, BATCH_SIZE)
+                    if after_id is None:
+                        set_version(conn, i)
+                        break
+                log.debug('Migration {} is done up to id {}'.format(i, after_id))
+            continue
+        log.info('Applying migration {}: {}'.format(i, func.__name__))
+        with engine.begin() as conn:
+            func(conn)
+            set_version(conn, i)
+    return latest_version()
+
+
+def stamp(engine):
+    """
+    Mark a database as being at the latest schema version.
+
+    :param engine: SQLAlchemy engine.
+    :return:
+    """
+    with engine.begin() as conn:
+        set_version(conn, latest_version())
+
+
+@migration
+def add_logdata_session_timestamp_index(conn):
+    conn.execute('CREATE INDEX IF NOT EXISTS ix_logdata_session_id_timestamp ON logdata (session_id, timestamp)')
+
+
+@batched_migration
+def add_logdata_ts(conn, after_id, batch_size):
+    if after_id is None:
+        if 'ts' not in column_names(conn, 'logdata'):
+            conn.execute('ALTER TABLE logdata ADD COLUMN ts BIGINT')
+        after_id = 0
+    last_id = conn.execute('SELECT max(id) FROM logdata').scalar() or 0
+    if after_id >= last_id:
+        # Building the index after the backfill is faster than maintaining it during the backfill.
+        conn.execute('CREATE INDEX IF NOT EXISTS ix_logdata_session_id_ts ON logdata (session_id, ts)')
+        return None
+    stop_id = after_id + batch_size
+    # SQLAlchemy stores DateTime values as 'YYYY-MM-DD HH:MM:SS.ffffff' strings in SQLite.
+    conn.execute('UPDATE logdata SET ts = '
+                 'CAST(strftime(\'%s\', substr(timestamp, 1, 19)) AS INTEGER) * 1000000000 + '
+                 'CAST(substr(timestamp, 21, 6) AS INTEGER) * 1000 '
+                 'WHERE id > ? AND id <= ? AND ts IS NULL AND timestamp IS NOT NULL',
+                 (after_id, stop_id))
+    return stop_id
+
+
+@migration
+def add_logsession_indexes(conn):
+    for column in ('start', 'user', 'name'):
+        conn.execute('CREATE INDEX IF NOT EXISTS ix_logsession_{0} ON logsession ("{0}")'.format(column))
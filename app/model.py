@@ -1,12 +1,16 @@
 import contextlib
+import itertools
 import json
 import logging
 import os
-from sqlalchemy import Column, ForeignKey, Integer, String, DateTime, Float
+import numpy as np
+from sqlalchemy import Column, ForeignKey, Index, Integer, BigInteger, String, DateTime, Float
+from sqlalchemy import select
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship, sessionmaker
 from sqlalchemy import create_engine
 from sqlalchemy import exc
+from . import migrations
 from . import utils
 
 log = logging.getLogger(__name__)
@@ -46,6 +50,10 @@ class LogSession(Base):
     name = Column(String, default='Collection')
     notes = Column(String, default=None)
     user = Column(String, default=None)
+    __table_args__ = (Index('ix_logsession_start', 'start'),
+                      Index('ix_logsession_user', 'user'),
+                      Index('ix_logsession_name', 'name'),
+                      )
 
     def __init__(self, name, notes=None, user=None):
         self.start = utils.now()
@@ -61,8 +69,43 @@ class LogData(Base):
     difference = Column(Float, default=0.0)
     unit = Column(String, default=None)
     timestamp = Column(DateTime, default=None)
+    # Nanoseconds since the unix epoch.
+    ts = Column(BigInteger, default=None)
     session_id = Column(Integer, ForeignKey('logsession.id'), index=True)
     session = relationship(LogSession)
+    __table_args__ = (Index('ix_logdata_session_id_timestamp', 'session_id', 'timestamp'),
+                      Index('ix_logdata_session_id_ts', 'session_id', 'ts'),
+                      )
+
+
+class LogStats(Base):
+    """
+    Optional streaming statistics, stored alongside the LogData row they were computed for.
+    """
+    __tablename__ = 'logstats'
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    logdata_id = Column(Integer, ForeignKey('logdata.id'))
+    logdata = relationship(LogData)
+    session_id = Column(Integer, ForeignKey('logsession.id'), index=True)
+    ewma = Column(Float)
+    mean = Column(Float)
+    stddev = Column(Float)
+    slope = Column(Float)
+
+
+class LogEvent(Base):
+    """
+    Compact records of the plateaus and steps found in a session's data.
+    """
+    __tablename__ = 'logevent'
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    session_id = Column(Integer, ForeignKey('logsession.id'), index=True)
+    kind = Column(String)
+    start = Column(DateTime)
+    stop = Column(DateTime)
+    mean = Column(Float)
+    delta = Column(Float, default=None)
+    samples = Column(Integer)
 
 
 def get_engine(fp):
@@ -77,12 +120,56 @@ def make_db(fp, remove=False):
             os.remove(fp)
         else:
             log.warning('Database already exists. [{}]'.format(fp))
+            upgrade_db(fp)
             return
     engine = get_engine(fp)
+    # This must be set before any tables are made.  It allows the maintain command to
+    # reclaim space without a full VACUUM.
+    engine.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    enable_wal(engine)
     Base.metadata.create_all(engine)
+    migrations.stamp(engine)
     return True
 
 
+def enable_wal(engine):
+    """
+    Switch a database to WAL mode, so readers, such as the dump command, do not block and are not blocked by a
+    collection which is writing to it.
+
+    The journal mode is stored in the database, so this only has to succeed once.  It cannot be changed while
+    another connection is using the database, in which case a warning is logged and the mode is left alone.
+
+    :param engine: SQLAlchemy engine.
+    :return: The journal mode of the database.
+    """
+    mode = engine.execute('PRAGMA journal_mode').scalar()
+    if mode == 'wal':
+        return mode
+    try:
+        return engine.execute('PRAGMA journal_mode=WAL').scalar()
+    except exc.OperationalError as e:
+        log.warning('Unable to switch the database to WAL mode, it is in {} mode: {}'.format(mode, e))
+        return mode
+
+
+def upgrade_db(fp):
+    """
+    Bring an existing database up to date with the models.
+
+    This should be called before a database is used, since databases made by
+    older versions may be missing tables, columns and indexes.
+
+    :param fp: Path to the database.
+    :return: The schema version of the database.
+    """
+    engine = get_engine(fp)
+    enable_wal(engine)
+    # Add any tables which are missing from an older database, then bring the rest up to date.
+    Base.metadata.create_all(engine)
+    return migrations.migrate(engine)
+
+
 def get_session(fp):
     engine = get_engine(fp)
     session = sessionmaker()
@@ -121,6 +208,74 @@ def session_scope(fp, commit=False, lock=None):
             session.close()
 
 
+def load_session_arrays(fp, session_id, start_ns=None, stop_ns=None):
+    """
+    Bulk load the data for a session into numpy arrays.
+
+    This issues a single Core query and builds the arrays directly from the
+    result rows, avoiding the creation of ORM objects for each row.  The
+    query is a range scan over the (session_id, ts) index.
+
+    :param fp: Path to the database.
+    :param session_id: LogSession id to load.
+    :param start_ns: Optional start of the time range to load, in nanoseconds since the unix epoch.
+    :param stop_ns: Optional end (exclusive) of the time range to load, in nanoseconds since the unix epoch.
+    :return: Tuple of (seconds since the first sample, data values) numpy arrays.
+    """
+    t = LogData.__table__
+    # Rows without a timestamp cannot be placed in time, and would sort first.
+    q = select([t.c.ts, t.c.data]).where(t.c.session_id == session_id).where(t.c.ts != None)
+    if start_ns is not None:
+        q = q.where(t.c.ts >= start_ns)
+    if stop_ns is not None:
+        q = q.where(t.c.ts < stop_ns)
+    q = q.order_by(t.c.ts)
+    engine = get_engine(fp)
+    with engine.connect() as conn:
+        result = conn.execute(q)
+        a = np.fromiter(itertools.chain.from_iterable(result), dtype=np.float64)
+    a = a.reshape(-1, 2)
+    times = a[:, 0]
+    if len(times):
+        times = (times - times[0]) / 1e9
+    return times, a[:, 1]
+
+
+def iter_sessions(fp, user=None, since=None, name=None, limit=None, offset=None):
+    """
+    Stream LogSession rows matching a set of filters.
+
+    The filters are covered by the indexes on the logsession table, and the
+    rows are read from the cursor as they are consumed instead of all at once.
+
+    :param fp: Path to the database.
+    :param user: Only sessions collected by this user.
+    :param since: Only sessions started at or after this datetime.
+    :param name: Only sessions whose name starts with this string.
+    :param limit: Maximum number of sessions.
+    :param offset: Number of matching sessions to skip.
+    :return: Generator of result rows.
+    """
+    t = LogSession.__table__
+    q = select([t])
+    if user is not None:
+        q = q.where(t.c.user == user)
+    if since is not None:
+        q = q.where(t.c.start >= since)
+    if name:
+        # A range on the prefix, unlike LIKE, can use the name index.
+        q = q.where(t.c.name >= name).where(t.c.name < name + '\U0010ffff')
+    q = q.order_by(t.c.id)
+    if limit is not None:
+        q = q.limit(limit)
+    if offset:
+        q = q.offset(offset)
+    engine = get_engine(fp)
+    with engine.connect() as conn:
+        for row in conn.execute(q):
+            yield row
+
+
 def row2dict(row):
     """
     http://stackoverflow.com/a/1960546
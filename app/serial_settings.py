@@ -16,3 +16,14 @@ MT_NCLASSIC_DEFAULT = {
     'xonxoff': True,
     'timeout': 60
 }
+
+# Mettler-Toledo balances driven with MT-SICS commands.
+# The short timeout lets the driver notice lost requests and resend them.
+MT_SICS_DEFAULT = {
+    'baudrate': 9600,
+    'bytesize': serial.EIGHTBITS,
+    'parity': serial.PARITY_NONE,
+    'stopbits': serial.STOPBITS_ONE,
+    'xonxoff': True,
+    'timeout': 1
+}
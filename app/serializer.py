@@ -1,10 +1,12 @@
+import itertools
 import logging
 import threading
 import multiprocessing
 import queue
 
-from .model import session_scope, make_db, LogSession, LogData
-from . import constants
+from .model import session_scope, make_db, LogSession, LogData, LogStats, LogEvent
+from . import events
+from . import stats
 from . import utils
 
 log = logging.getLogger(__name__)
@@ -19,6 +21,13 @@ class DBSerializer(threading.Thread):
                  db_fp: str,
                  logsession: LogSession,
                  print_diff: bool =True,
+                 stats_window: int =30,
+                 ewma_alpha: float =0.1,
+                 persist_stats: bool =False,
+                 detect_events: bool =True,
+                 event_window: int =10,
+                 event_tolerance: float =0.01,
+                 min_step: float =0.05,
                  **kwargs):
         super().__init__()
         self.queue = output_queue
@@ -29,15 +38,19 @@ class DBSerializer(threading.Thread):
         self.session_id = None
         self.previous_value = 0.0
         self.print_diff = print_diff
+        self.stats = stats.StreamingStats(window=stats_window, alpha=ewma_alpha)
+        self.persist_stats = persist_stats
+        self.detector = None
+        if detect_events:
+            self.detector = events.PlateauDetector(window=event_window,
+                                                   tolerance=event_tolerance,
+                                                   min_step=min_step)
         make_db(self.db)
 
     def run(self):
         log.info('{} is running!'.format(self.name))
 
-        with session_scope(self.db, commit=True, lock=self.lock) as s:
-            s.add(self.ls)
-            s.commit()
-            self.session_id = self.ls.id
+        self.open_session()
 
         while True:
             if self.die_event.is_set():
@@ -51,34 +64,115 @@ class DBSerializer(threading.Thread):
 
             log.debug('{} got: {}'.format(self.name, v))
 
-            unit = constants.UNKNOWN_UNIT
-            if isinstance(v, str):
-                m = constants.EMISSION_REGEX.search(v)
-                if not m:
-                    pass # XXX ????
-                d = m.groupdict()
-                unit = d.get('unit')
-                v = float(d.get('value'))
-            elif isinstance(v, str):
-                v = float(v)
-
-            difference = v - self.previous_value
-            self.previous_value = v
-            if self.print_diff:
-                log.info('Diff: {}'.format(difference))
+            # Each batch of samples from the DAQ is written in one transaction.
+            with session_scope(self.db, commit=True, lock=self.lock) as s:
+                for sample in v:
+                    self.add_sample(s, sample)
 
+        self.close_session()
+        log.info('[{}] is exiting'.format(self.name))
+        return
+
+    def write_samples(self, samples, batch_size: int =1000):
+        """
+        Write samples straight into a new session, without running the thread.
+
+        This is used to write data as fast as it can be produced, such as when
+        reprocessing a capture.  Rows are committed once per batch, and the
+        session start and stop are set from the sample timestamps.
+
+        :param samples: Iterable of daq.Sample tuples.
+        :param batch_size: Number of samples to commit at once.
+        :return: Number of samples written.
+        """
+        self.open_session()
+        samples = iter(samples)
+        count = 0
+        first_ts = None
+        last_ts = None
+        while True:
+            batch = list(itertools.islice(samples, batch_size))
+            if not batch:
+                break
             with session_scope(self.db, commit=True, lock=self.lock) as s:
-                ld = LogData(data=v,
-                             unit=unit,
-                             difference=difference,
-                             timestamp=utils.now(),
-                             session_id=self.session_id)
-                s.add(ld)
+                for v in batch:
+                    self.add_sample(s, v)
+            if first_ts is None:
+                first_ts = batch[0][0]
+            last_ts = batch[-1][0]
+            count += len(batch)
+            log.debug('Wrote {} samples'.format(count))
+        start = stop = None
+        if count:
+            start = utils.ns_to_datetime(first_ts)
+            stop = utils.ns_to_datetime(last_ts)
+        self.close_session(start=start, stop=stop)
+        return count
+
+    def open_session(self):
+        with session_scope(self.db, commit=True, lock=self.lock) as s:
+            s.add(self.ls)
+            s.commit()
+            self.session_id = self.ls.id
 
+    def close_session(self, start=None, stop=None):
+        """
+        Record any remaining events and set the stop time of the session.
+
+        :param start: Optional datetime to replace the session start time with.
+        :param stop: Optional datetime to use as the stop time.  Defaults to the current time.
+        :return:
+        """
         log.info('Closing session: {}'.format(self.session_id))
         with session_scope(self.db, commit=True, lock=self.lock) as s:
+            if self.detector:
+                self.add_events(s, self.detector.flush())
             ls = s.query(LogSession).filter_by(id=self.session_id).one()
-            ls.stop = utils.now()
+            if start:
+                ls.start = start
+            ls.stop = stop or utils.now()
             s.add(ls)
-        log.info('[{}] is exiting'.format(self.name))
-        return
+
+    def add_sample(self, s, v):
+        """
+        Add the rows for a sample to a session.
+
+        :param s: SQLAlchemy session.
+        :param v: daq.Sample tuple.
+        :return:
+        """
+        ts, v, unit = v
+
+        difference = v - self.previous_value
+        self.previous_value = v
+        timestamp = utils.ns_to_datetime(ts)
+        sample = self.stats.update(v, ts / 1e9)
+        if self.print_diff:
+            log.info('Diff: {} Drift: {}/min'.format(difference, sample.slope))
+
+        ld = LogData(data=v,
+                     unit=unit,
+                     difference=difference,
+                     timestamp=timestamp,
+                     ts=ts,
+                     session_id=self.session_id)
+        s.add(ld)
+        if self.persist_stats:
+            # The relationship lets the unit of work fill in logdata_id when the batch is flushed.
+            s.add(LogStats(logdata=ld,
+                           session_id=self.session_id,
+                           **sample._asdict()))
+        if self.detector:
+            self.add_events(s, self.detector.update(v, timestamp))
+
+    def add_events(self, s, records):
+        """
+        Add LogEvent rows for a list of EventRecord tuples to a session.
+
+        :param s: SQLAlchemy session.
+        :param records: List of events.EventRecord tuples.
+        :return:
+        """
+        for record in records:
+            log.info('Event: {} mean: {} delta: {}'.format(record.kind, record.mean, record.delta))
+            s.add(LogEvent(session_id=self.session_id, **record._asdict()))
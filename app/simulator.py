@@ -0,0 +1,359 @@
+"""
+Pseudo-terminal based Mettler-Toledo balance simulator.
+
+Each simulator opens a pty and writes balance output to it, either replayed
+from a raw serial capture or generated in the MT HOST or PRINTER formats.
+The SICS simulator instead answers MT-SICS commands written to the pty.
+The slave side of the pty behaves like a serial port, so the real
+MettlerNBDAQ reader, parser and stable_only logic can be load tested
+without a balance attached.  Output is paced to the configured baud rate
+and line rate.
+
+This requires a POSIX system with pty support, such as Linux.
+"""
+import collections
+import logging
+import multiprocessing
+import os
+import random
+import select
+import threading
+import time
+
+try:
+    import tty
+except ImportError:
+    tty = None
+
+from . import capture
+
+log = logging.getLogger(__name__)
+
+HOST = 'host'
+PRINTER = 'printer'
+MODES = (HOST, PRINTER)
+
+# 8N1 framing - one start bit, eight data bits and one stop bit per byte.
+BITS_PER_BYTE = 10
+
+
+class SimulatorError(Exception):
+    pass
+
+
+def format_line(value: float, stable: bool, mode: str =HOST, unit: str ='g', decimals: int =3) -> bytes:
+    """
+    Format a weight the way the balance prints it.
+
+    HOST mode lines start with 'S S' for stable values and 'S D' for dynamic
+    (unstable) values.  PRINTER mode lines only have a 'D' marker on
+    unstable values.
+
+    :param value: Weight.
+    :param stable: If the weight is stable.
+    :param mode: HOST or PRINTER.
+    :param unit: Unit of the weight.
+    :param decimals: Number of decimal places printed.
+    :return: The line, including the CR LF terminator.
+    """
+    v = '{:>10.{}f}'.format(value, decimals)
+    if mode == HOST:
+        s = 'S {} {} {}'.format('S' if stable else 'D', v, unit)
+    elif mode == PRINTER:
+        s = '{} {} {}'.format(' ' if stable else 'D', v, unit)
+    else:
+        raise SimulatorError('Unknown mode: {}'.format(mode))
+    return '{}\r\n'.format(s).encode()
+
+
+def generate_weights(decimals: int =3,
+                     noise: float =0.0005,
+                     step_every: int =200,
+                     seed=None):
+    """
+    Generate an endless stream of simulated weights.
+
+    The weight settles onto a new random load every step_every readings.
+    Readings are marked unstable while the weight is still settling.
+
+    :param decimals: Number of decimal places the balance resolves.
+    :param noise: Standard deviation of the noise added to the weight.
+    :param step_every: Number of readings between changes in the load.
+    :param seed: Seed for the random number generator.
+    :return: Generator of (weight, stable) tuples.
+    """
+    rng = random.Random(seed)
+    resolution = 10 ** -decimals
+    weight = 0.0
+    target = 0.0
+    i = 0
+    while True:
+        if i % step_every == 0:
+            target = round(rng.uniform(0.0, 100.0), decimals)
+        weight += (target - weight) * 0.2
+        stable = abs(target - weight) < resolution
+        yield weight + rng.gauss(0.0, noise), stable
+        i += 1
+
+
+def generate_lines(mode: str =HOST,
+                   unit: str ='g',
+                   decimals: int =3,
+                   noise: float =0.0005,
+                   step_every: int =200,
+                   seed=None):
+    """
+    Generate an endless stream of balance lines.
+
+    :param mode: HOST or PRINTER.
+    :param unit: Unit of the weight.
+    :param decimals: Number of decimal places printed.
+    :param noise: Standard deviation of the noise added to the weight.
+    :param step_every: Number of lines between changes in the load.
+    :param seed: Seed for the random number generator.
+    :return:
+    """
+    for weight, stable in generate_weights(decimals=decimals, noise=noise, step_every=step_every, seed=seed):
+        yield format_line(weight, stable, mode=mode, unit=unit, decimals=decimals)
+
+
+def capture_lines(fp: str, loop: bool =False):
+    """
+    Replay the lines of a raw serial capture file.
+
+    :param fp: Path to a file of raw bytes read from a balance, or a capture file.
+    :param loop: Start again from the beginning of the file when the end is reached.
+    :return:
+    """
+    recorded = capture.is_capture(fp)
+    while True:
+        if recorded:
+            for ts, line in capture.iter_capture(fp):
+                yield line
+        else:
+            with open(fp, 'rb') as f:
+                for line in f:
+                    yield line
+        if not loop:
+            break
+
+
+class BalanceSimulator(threading.Thread):
+    """
+    Writes balance lines to a pty at a given baud rate and line rate.
+
+    The path of the serial port to connect to is available as the port
+    attribute as soon as the simulator is made.
+    """
+    def __init__(self,
+                 lines,
+                 die_event: multiprocessing.Event,
+                 baudrate: int =9600,
+                 line_rate: float =None,
+                 ):
+        """
+        :param lines: Iterable of lines (bytes) to write.
+        :param die_event: Event used to stop the simulator.
+        :param baudrate: Simulated baud rate.  Each line takes at least as long as it would to send at this rate.
+        :param line_rate: Maximum number of lines per second.  If None, lines are only limited by the baud rate.
+        """
+        super().__init__()
+        if tty is None:
+            raise SimulatorError('The balance simulator requires pty support.')
+        self.lines = lines
+        self.die_event = die_event
+        self.baudrate = baudrate
+        self.line_rate = line_rate
+        self.master, self.slave = os.openpty()
+        # Raw mode stops the line discipline from echoing or translating line endings.
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self.count = 0
+        self.elapsed = 0.0
+
+    def line_period(self, line: bytes) -> float:
+        period = len(line) * BITS_PER_BYTE / self.baudrate
+        if self.line_rate:
+            period = max(period, 1.0 / self.line_rate)
+        return period
+
+    def run(self):
+        log.info('{} is running on [{}]'.format(self.name, self.port))
+        start = time.monotonic()
+        deadline = start
+        try:
+            for line in self.lines:
+                if self.die_event.is_set():
+                    log.info('[{}] Die event set'.format(self.name))
+                    break
+                delay = deadline - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                if not self.write(line):
+                    break
+                self.count += 1
+                deadline += self.line_period(line)
+            else:
+                log.info('[{}] No more lines to send'.format(self.name))
+        finally:
+            self.elapsed = time.monotonic() - start
+            os.close(self.master)
+            os.close(self.slave)
+        log.info('[{}] Sent {} lines in {:.3f}s ({:.1f} lines/s)'.format(self.name,
+                                                                       self.count,
+                                                                       self.elapsed,
+                                                                       self.rate))
+        log.info('[{}] is exiting'.format(self.name))
+
+    def write(self, data: bytes) -> bool:
+        """
+        Write all of data to the pty, giving up if the die event is set while the reader is not keeping up.
+
+        :param data: Bytes to write.
+        :return: True if all of the data was written.
+        """
+        while data:
+            _, w, _ = select.select([], [self.master], [], 0.1)
+            if not w:
+                if self.die_event.is_set():
+                    return False
+                continue
+            n = os.write(self.master, data)
+            data = data[n:]
+        return True
+
+    @property
+    def rate(self) -> float:
+        if not self.elapsed:
+            return 0.0
+        return self.count / self.elapsed
+
+
+class SICSBalanceSimulator(BalanceSimulator):
+    """
+    Answers MT-SICS commands written to a pty, like a balance in SICS mode.
+
+    Supported commands are SI (immediate weight), S (stable weight, which is
+    answered the same way as SI), SIR (immediate weights, repeated until
+    another command is received) and @ (reset).  Anything else is answered
+    with ES (syntax error).  Responses are delayed by the processing latency
+    and paced by the baud rate, and continuous SIR output is also limited by
+    the line rate.
+    """
+    def __init__(self,
+                 die_event: multiprocessing.Event,
+                 baudrate: int =9600,
+                 line_rate: float =None,
+                 latency: float =0.0,
+                 unit: str ='g',
+                 noise: float =0.0005,
+                 seed=None,
+                 ):
+        """
+        :param die_event: Event used to stop the simulator.
+        :param baudrate: Simulated baud rate.
+        :param line_rate: Maximum number of SIR lines per second.  If None, lines are only limited by the baud rate.
+        :param latency: Time the balance takes to process a command, in seconds.
+        :param unit: Unit of the weights.
+        :param noise: Standard deviation of the noise added to the weights.
+        :param seed: Seed for the random number generator.
+        """
+        super().__init__(lines=None,
+                         die_event=die_event,
+                         baudrate=baudrate,
+                         line_rate=line_rate)
+        self.weights = generate_weights(noise=noise, seed=seed)
+        self.latency = latency
+        self.unit = unit
+        self.commands = 0
+        self.continuous = False
+        self.pending = collections.deque()
+        self.busy_until = 0.0
+        self.next_line = 0.0
+
+    def run(self):
+        log.info('{} is running on [{}]'.format(self.name, self.port))
+        start = time.monotonic()
+        buf = b''
+        try:
+            while not self.die_event.is_set():
+                r, _, _ = select.select([self.master], [], [], self.timeout())
+                if r:
+                    buf += os.read(self.master, 1024)
+                    *commands, buf = buf.split(b'\n')
+                    for command in commands:
+                        self.handle(command.strip().decode(errors='replace'))
+                if not self.flush():
+                    break
+        finally:
+            self.elapsed = time.monotonic() - start
+            os.close(self.master)
+            os.close(self.slave)
+        log.info('[{}] Answered {} commands with {} lines in {:.3f}s ({:.1f} lines/s)'.format(self.name,
+                                                                                            self.commands,
+                                                                                            self.count,
+                                                                                            self.elapsed,
+                                                                                            self.rate))
+        log.info('[{}] is exiting'.format(self.name))
+
+    def timeout(self) -> float:
+        t = 0.1
+        now = time.monotonic()
+        if self.pending:
+            t = min(t, self.pending[0][0] - now)
+        if self.continuous:
+            t = min(t, self.next_line - now)
+        return max(t, 0.0)
+
+    def schedule(self, line: bytes, ready: float):
+        """
+        Queue a line to be written once it is ready and the simulated serial line is free.
+
+        :param line: Line to write.
+        :param ready: Earliest monotonic time to write the line at.
+        :return: The time the line will be written.
+        """
+        at = max(ready, self.busy_until)
+        self.busy_until = at + len(line) * BITS_PER_BYTE / self.baudrate
+        self.pending.append((at, line))
+        return at
+
+    def weight_line(self) -> bytes:
+        weight, stable = next(self.weights)
+        return format_line(weight, stable, mode=HOST, unit=self.unit)
+
+    def handle(self, command: str):
+        if not command:
+            return
+        self.commands += 1
+        ready = time.monotonic() + self.latency
+        # Any command cancels continuous output.
+        self.continuous = False
+        if command in ('SI', 'S'):
+            self.schedule(self.weight_line(), ready)
+        elif command == 'SIR':
+            self.continuous = True
+            self.next_line = ready
+        elif command == '@':
+            self.pending.clear()
+            self.schedule(b'I4 A "0123456789"\r\n', ready)
+        else:
+            self.schedule(b'ES\r\n', ready)
+
+    def flush(self) -> bool:
+        """
+        Write any lines which are due, and the next continuous line if it is due.
+
+        :return: False if writing was abandoned because the die event was set.
+        """
+        now = time.monotonic()
+        if self.continuous and now >= self.next_line:
+            at = self.schedule(self.weight_line(), self.next_line)
+            period = 1.0 / self.line_rate if self.line_rate else 0.0
+            self.next_line = max(at + period, self.busy_until)
+        while self.pending and self.pending[0][0] <= now:
+            _, line = self.pending.popleft()
+            if not self.write(line):
+                return False
+            self.count += 1
+        return True
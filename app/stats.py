@@ -0,0 +1,200 @@
+"""
+Streaming statistics for live data.
+
+Each of these classes does a constant amount of work per sample, so they
+can sit in the collection pipeline without recomputing anything over the
+full window each time a new value arrives.
+"""
+import collections
+import logging
+import math
+
+log = logging.getLogger(__name__)
+
+StatsSample = collections.namedtuple('StatsSample', ['ewma', 'mean', 'stddev', 'slope'])
+
+
+class EWMA(object):
+    """
+    Exponentially weighted moving average.
+    """
+    def __init__(self, alpha: float =0.1):
+        if not 0.0 < alpha <= 1.0:
+            raise ValueError('alpha must be in the range (0, 1]')
+        self.alpha = alpha
+        self.value = None
+
+    def update(self, x: float) -> float:
+        if self.value is None:
+            self.value = x
+        else:
+            self.value += self.alpha * (x - self.value)
+        return self.value
+
+
+class RollingStats(object):
+    """
+    Windowed mean and variance using Welford's algorithm.
+
+    Values are added to and removed from the running moments as they enter
+    and leave the window, so each update is O(1).  The moments are rebuilt
+    from the window once per window's worth of samples so that rounding
+    error cannot accumulate over a long session; this is still O(1) amortized.
+    """
+    def __init__(self, window: int =30):
+        if window < 2:
+            raise ValueError('window must be at least 2')
+        self.window = window
+        self.values = collections.deque()
+        self.mean = 0.0
+        self._m2 = 0.0
+        self._updates = 0
+
+    def __len__(self):
+        return len(self.values)
+
+    def update(self, x: float):
+        if len(self.values) == self.window:
+            self._remove(self.values[0])
+            self.values.popleft()
+        self.values.append(x)
+        self._updates += 1
+        if self._updates >= self.window:
+            self._rebuild()
+            return
+        n = len(self.values)
+        delta = x - self.mean
+        self.mean += delta / n
+        self._m2 += delta * (x - self.mean)
+
+    def clear(self):
+        self.values.clear()
+        self.mean = 0.0
+        self._m2 = 0.0
+        self._updates = 0
+
+    def _rebuild(self):
+        n = len(self.values)
+        self.mean = sum(self.values) / n
+        self._m2 = sum((v - self.mean) ** 2 for v in self.values)
+        self._updates = 0
+
+    def _remove(self, x: float):
+        n = len(self.values)
+        if n == 1:
+            self.mean = 0.0
+            self._m2 = 0.0
+            return
+        old_mean = self.mean
+        self.mean = (n * old_mean - x) / (n - 1)
+        self._m2 -= (x - old_mean) * (x - self.mean)
+
+    @property
+    def variance(self) -> float:
+        n = len(self.values)
+        if n < 2:
+            return 0.0
+        # Floating point error can push the running moment slightly negative.
+        return max(self._m2, 0.0) / (n - 1)
+
+    @property
+    def stddev(self) -> float:
+        return math.sqrt(self.variance)
+
+
+class RollingSlope(object):
+    """
+    Least squares slope of (t, x) pairs over a sliding window.
+
+    The co-moment of t and x and the second moment of t are maintained with
+    Welford style add/remove updates, which avoids the cancellation problems
+    of the naive sum-of-squares formula when t is a large timestamp.  Times
+    are measured from the first point seen, and the moments are periodically
+    rebuilt from the window the same way RollingStats does.
+    """
+    def __init__(self, window: int =30):
+        if window < 2:
+            raise ValueError('window must be at least 2')
+        self.window = window
+        self.points = collections.deque()
+        self.origin = None
+        self.mean_t = 0.0
+        self.mean_x = 0.0
+        self._m2_t = 0.0
+        self._c_tx = 0.0
+        self._updates = 0
+
+    def update(self, t: float, x: float):
+        if self.origin is None:
+            self.origin = t
+        t -= self.origin
+        if len(self.points) == self.window:
+            self._remove(*self.points[0])
+            self.points.popleft()
+        self.points.append((t, x))
+        self._updates += 1
+        if self._updates >= self.window:
+            self._rebuild()
+            return
+        n = len(self.points)
+        dt = t - self.mean_t
+        self.mean_t += dt / n
+        self.mean_x += (x - self.mean_x) / n
+        self._m2_t += dt * (t - self.mean_t)
+        self._c_tx += dt * (x - self.mean_x)
+
+    def _rebuild(self):
+        n = len(self.points)
+        self.mean_t = sum(p[0] for p in self.points) / n
+        self.mean_x = sum(p[1] for p in self.points) / n
+        self._m2_t = sum((p[0] - self.mean_t) ** 2 for p in self.points)
+        self._c_tx = sum((p[0] - self.mean_t) * (p[1] - self.mean_x) for p in self.points)
+        self._updates = 0
+
+    def _remove(self, t: float, x: float):
+        n = len(self.points)
+        if n == 1:
+            self.mean_t = 0.0
+            self.mean_x = 0.0
+            self._m2_t = 0.0
+            self._c_tx = 0.0
+            return
+        old_mean_t = self.mean_t
+        self.mean_t = (n * old_mean_t - t) / (n - 1)
+        self.mean_x = (n * self.mean_x - x) / (n - 1)
+        self._m2_t -= (t - old_mean_t) * (t - self.mean_t)
+        self._c_tx -= (t - old_mean_t) * (x - self.mean_x)
+
+    @property
+    def slope(self) -> float:
+        if len(self.points) < 2 or self._m2_t <= 0.0:
+            return 0.0
+        return self._c_tx / self._m2_t
+
+
+class StreamingStats(object):
+    """
+    Combines the EWMA, rolling mean/stddev and rolling slope into a single
+    pipeline stage.
+
+    Timestamps are given in seconds; the slope is reported in units per minute.
+    """
+    def __init__(self, window: int =30, alpha: float =0.1):
+        self.ewma = EWMA(alpha=alpha)
+        self.rolling = RollingStats(window=window)
+        self.slope = RollingSlope(window=window)
+
+    def update(self, x: float, t: float) -> StatsSample:
+        """
+        Add a sample and get the current statistics.
+
+        :param x: Measured value.
+        :param t: Time of the measurement, in seconds.
+        :return: A StatsSample tuple.
+        """
+        self.rolling.update(x)
+        self.slope.update(t, x)
+        return StatsSample(ewma=self.ewma.update(x),
+                           mean=self.rolling.mean,
+                           stddev=self.rolling.stddev,
+                           slope=self.slope.slope * 60.0)
@@ -1,6 +1,9 @@
 import datetime
+import itertools
 import os
+import sys
 import textwrap
+import time
 
 import terminaltables
 
@@ -11,6 +14,9 @@ except ImportError:
 
     pwd = None
 
+EPOCH = datetime.datetime(1970, 1, 1)
+DATE_FORMATS = ('%Y-%m-%d', '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S')
+
 
 class BetterAsciiTable(terminaltables.AsciiTable):
     def __init__(self, *args, **kwargs):
@@ -50,6 +56,98 @@ class BetterAsciiTable(terminaltables.AsciiTable):
             self.table_data.append(t)
 
 
+class StreamingTable(object):
+    """
+    Prints an ascii table one row at a time, in the same style as BetterAsciiTable.
+
+    Column widths are either given, or derived from the first sample_rows rows,
+    so only those rows are held in memory before printing starts.  Values
+    wider than their column are wrapped onto extra lines.
+    """
+    def __init__(self,
+                 columns: list,
+                 widths: dict =None,
+                 max_width: int =37,
+                 sample_rows: int =100,
+                 out=None):
+        """
+        :param columns: Column names, in the order they are printed.
+        :param widths: Dictionary of fixed widths for some or all of the columns.
+        :param max_width: Maximum derived column width.
+        :param sample_rows: Number of rows used to derive column widths.
+        :param out: File to print to.  Defaults to stdout.
+        """
+        self.columns = [str(c) for c in columns]
+        self.widths = dict(widths or {})
+        self.max_width = max_width
+        self.sample_rows = sample_rows
+        self.out = out or sys.stdout
+        self.count = 0
+
+    def derive_widths(self, rows: list):
+        for c in self.columns:
+            if c in self.widths:
+                continue
+            width = max([len(c)] + [len(str(row.get(c))) for row in rows])
+            self.widths[c] = max(min(width, self.max_width), len(c))
+
+    def separator(self) -> str:
+        return '+' + '+'.join('-' * (self.widths.get(c) + 2) for c in self.columns) + '+'
+
+    def format_row(self, values: list) -> str:
+        cells = []
+        for c, v in zip(self.columns, values):
+            width = self.widths.get(c)
+            v = str(v)
+            cells.append(textwrap.wrap(v, width) if len(v) > width else [v])
+        lines = []
+        for i in range(max(len(cell) for cell in cells)):
+            parts = []
+            for c, cell in zip(self.columns, cells):
+                parts.append(' {} '.format((cell[i] if i < len(cell) else '').ljust(self.widths.get(c))))
+            lines.append('|' + '|'.join(parts) + '|')
+        return '\n'.join(lines)
+
+    def write(self, text: str):
+        self.out.write(text + '\n')
+
+    def print_rows(self, rows) -> int:
+        """
+        Print a table of rows.  Each row should be a dictionary, or a mapping such as a SQLAlchemy result row.
+
+        :param rows: Iterable of rows.
+        :return: Number of rows printed.
+        """
+        rows = iter(rows)
+        sample = [dict(row) for row in itertools.islice(rows, self.sample_rows)]
+        if not sample:
+            return 0
+        self.derive_widths(sample)
+        self.write(self.separator())
+        self.write(self.format_row(self.columns))
+        self.write(self.separator())
+        for row in itertools.chain(sample, (dict(row) for row in rows)):
+            self.write(self.format_row([row.get(c) for c in self.columns]))
+            self.count += 1
+        self.write(self.separator())
+        return self.count
+
+
+def parse_date(s: str) -> datetime.datetime:
+    """
+    Parse a date, or a date and time, given on the command line.
+
+    :param s: Date string, such as 2016-04-03 or 2016-04-03T15:08:46.
+    :return: datetime object.
+    """
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(s, fmt)
+        except ValueError:
+            continue
+    raise ValueError('Unable to parse date: {}'.format(s))
+
+
 def now():
     """
     Get a datedate object representing the current UTC time.
@@ -59,6 +157,42 @@ def now():
     return datetime.datetime.utcnow()
 
 
+def ns_to_datetime(ts):
+    """
+    Convert integer nanoseconds since the unix epoch into a naive UTC datetime object.
+
+    :param ts: Nanoseconds since the unix epoch.
+    :return:
+    """
+    return EPOCH + datetime.timedelta(microseconds=ts // 1000)
+
+
+class Clock(object):
+    """
+    Wall clock timestamps which are derived from the monotonic clock.
+
+    The wall clock and the monotonic clock are read once, when the clock is
+    made.  After that, timestamps are the wall clock reference plus the
+    monotonic time elapsed since then.  Samples stamped by a Clock are
+    therefore always ordered, even if the system clock is stepped during a
+    session.
+    """
+    def __init__(self):
+        # Bracket the wall clock read with monotonic reads, and use their midpoint.
+        before = time.monotonic_ns()
+        self.wall_ns = time.time_ns()
+        after = time.monotonic_ns()
+        self.monotonic_ns = (before + after) // 2
+
+    def now_ns(self):
+        """
+        Get the current time as integer nanoseconds since the unix epoch.
+
+        :return:
+        """
+        return self.wall_ns + time.monotonic_ns() - self.monotonic_ns
+
+
 def current_user():
     """
     http://stackoverflow.com/a/19865396
@@ -0,0 +1,88 @@
+import numpy as np
+import pytest
+
+from app import encoding
+
+START = 1459696126000000000
+
+
+def round_trip(tmp_path, ts, values, unit_codes=None, units=('g',), block_size=4096):
+    if unit_codes is None:
+        unit_codes = np.zeros(len(ts), dtype=np.int64)
+    fp = str(tmp_path / 'session.dgts')
+    with encoding.EncodedWriter(fp, session={'id': 1}, units=list(units), block_size=block_size) as writer:
+        writer.write(ts, values, unit_codes)
+    header, block = encoding.read_encoded(fp)
+    assert header.get('session') == {'id': 1}
+    assert writer.count == len(ts)
+    np.testing.assert_array_equal(block.ts, np.asarray(ts, dtype=np.int64))
+    # Compare the bits, so that NaN, inf and -0.0 have to come back exactly.
+    np.testing.assert_array_equal(block.values.view(np.uint64),
+                                  np.asarray(values, dtype=np.float64).view(np.uint64))
+    np.testing.assert_array_equal(block.units, np.array(units)[unit_codes])
+    return block
+
+
+def block_header(values):
+    data = encoding.encode_block(jittered_ts(len(values)), values, np.zeros(len(values)))
+    return encoding.BLOCK.unpack(data[:encoding.BLOCK.size])
+
+
+def jittered_ts(n, seed=0):
+    rng = np.random.RandomState(seed)
+    return START + np.cumsum(100000000 + rng.randint(-50000, 50000, size=n)).astype(np.int64)
+
+
+def test_scaled_block(tmp_path):
+    rng = np.random.RandomState(1)
+    values = np.round(50.0 + np.cumsum(rng.normal(0, 0.01, size=1000)), 3)
+    round_trip(tmp_path, jittered_ts(1000), values)
+    header = block_header(values[:10])
+    assert header[4] == encoding.SCALED
+    assert header[5] == 3
+
+
+def test_xor_block(tmp_path):
+    values = np.random.RandomState(2).normal(0, 1, size=1000)
+    round_trip(tmp_path, jittered_ts(1000), values)
+    header = block_header(values[:10])
+    assert header[4] == encoding.XOR
+
+
+@pytest.mark.parametrize('n', [1, 2, 3])
+def test_small_blocks(tmp_path, n):
+    values = np.round(np.linspace(1.0, 2.0, 7), 2)
+    # A block size of n splits the samples into blocks of n, with a shorter block at the end.
+    round_trip(tmp_path, jittered_ts(7), values, block_size=n)
+
+
+@pytest.mark.parametrize('n', [1, 2])
+def test_single_block_of_one_or_two(tmp_path, n):
+    round_trip(tmp_path, jittered_ts(n), [12.345, 12.346][:n])
+    round_trip(tmp_path, jittered_ts(n), [0.1 + 0.2, 1.0 / 3.0][:n])
+
+
+def test_non_finite_values(tmp_path):
+    values = [1.5, np.nan, np.inf, -np.inf, -0.0, 2.25]
+    round_trip(tmp_path, jittered_ts(len(values)), values, block_size=4)
+
+
+def test_units(tmp_path):
+    codes = np.array([0, 0, 1, 1, 0, 2])
+    round_trip(tmp_path, jittered_ts(6), np.arange(6.0), unit_codes=codes, units=('g', 'mg', 'unknownUnit'))
+
+
+def test_empty(tmp_path):
+    fp = str(tmp_path / 'empty.dgts')
+    with encoding.EncodedWriter(fp, session={}, units=[]):
+        pass
+    _, block = encoding.read_encoded(fp)
+    assert len(block.ts) == 0
+    assert list(encoding.iter_blocks(fp)) == []
+
+
+def test_not_an_encoded_file(tmp_path):
+    fp = tmp_path / 'bad.dgts'
+    fp.write_bytes(b'not encoded')
+    with pytest.raises(encoding.EncodingError):
+        encoding.read_header(str(fp))
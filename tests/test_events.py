@@ -0,0 +1,29 @@
+from app import events
+
+
+def run(detector, values):
+    records = []
+    for i, x in enumerate(values):
+        records.extend(detector.update(x, i))
+    records.extend(detector.flush())
+    return records
+
+
+def test_step_between_plateaus():
+    values = [1.0] * 30 + [1.5] * 30
+    records = run(events.PlateauDetector(), values)
+    assert [r.kind for r in records] == [events.PLATEAU, events.ADDED, events.PLATEAU]
+    first, step, second = records
+    assert (first.start, first.stop) == (0, 29)
+    assert (second.start, second.stop) == (30, 59)
+    assert abs(step.delta - 0.5) < 1e-9
+
+
+def test_drifting_signal_plateaus_do_not_overlap():
+    # Slow drift, such as evaporation, which leaves each plateau after a while.
+    values = [0.0005 * i for i in range(500)]
+    records = [r for r in run(events.PlateauDetector(), values) if r.kind == events.PLATEAU]
+    assert len(records) > 1
+    for previous, current in zip(records, records[1:]):
+        assert current.start > previous.stop
+    assert sum(r.samples for r in records) <= len(values)